@@ -30,15 +30,27 @@
 # POSSIBILITY OF SUCH DAMAGE
 
 from __future__ import unicode_literals
+from datetime import datetime, time, timedelta
 
+from django.conf.urls import url
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
+from django.core.exceptions import PermissionDenied
 from django.core.urlresolvers import reverse
+from django.db import connection
+from django.db.models import F
+from django.utils import timezone
 from django.utils.html import format_html
 from import_export.widgets import ForeignKeyWidget
 from djangoplicity.contrib import admin as dpadmin
 from django.conf import settings
+from djangoplicity.visits.exports import RESERVATION_COLUMNS, \
+    ShowingFormatter, export_response, iter_reservation_rows
+from djangoplicity.visits.forms import ReservationAdminForm
 from djangoplicity.visits.models import Activity, ActivityProxy,\
-    Language, Reservation, Showing
+    Language, OutboxEmail, Reservation, Showing, RESERVATION_SEARCH_FIELDS, \
+    generate_code, next_reservation_ids
+from djangoplicity.visits.paginators import EstimatedCountPaginator
 from django.utils.translation import gettext_lazy as _
 from import_export import resources, fields
 from import_export.admin import ImportExportModelAdmin
@@ -96,7 +108,7 @@ class ReservationResource(resources.ModelResource):
     time = fields.Field()
 
     def dehydrate_date(self, reservation): # noqa
-        return reservation.showing.start_time.strftime('%Y-%m-%d'),
+        return reservation.showing.start_time.strftime('%Y-%m-%d')
 
     def dehydrate_time(self, reservation): # noqa
         if reservation.showing.timezone:
@@ -104,6 +116,39 @@ class ReservationResource(resources.ModelResource):
         else:
             return '{}'.format(reservation.showing.start_date_tz.strftime('%I:%M %p %Z'))
 
+    def before_import(self, dataset, using_transactions, dry_run, **kwargs):
+        self.new_reservations = []
+        self.reservation_ids = iter([])
+        if connection.vendor == 'postgresql':
+            # Take the PKs of the new reservations from the sequence at
+            # once, so their codes are known before they are inserted
+            count = sum(1 for row in dataset.dict if not row.get('id'))
+            if count:
+                self.reservation_ids = iter(next_reservation_ids(count))
+
+    def save_instance(self, instance, using_transactions=True, dry_run=False):
+        if not instance._state.adding or connection.vendor != 'postgresql':
+            return super(ReservationResource, self).save_instance(
+                instance, using_transactions, dry_run)
+
+        # New reservations are only inserted in bulk by after_import()
+        self.before_save_instance(instance, using_transactions, dry_run)
+        if instance.pk is None:
+            instance.pk = next(self.reservation_ids)
+        if not instance.code:
+            instance.code = generate_code(instance.pk)
+        self.new_reservations.append(instance)
+        self.after_save_instance(instance, using_transactions, dry_run)
+
+    def after_import(self, dataset, result, using_transactions, dry_run, **kwargs):
+        if self.new_reservations and not result.has_errors() and \
+                (using_transactions or not dry_run):
+            Reservation.objects.bulk_reserve(self.new_reservations)
+        self.new_reservations = []
+
+        super(ReservationResource, self).after_import(
+            dataset, result, using_transactions, dry_run, **kwargs)
+
     class Meta:
         model = Reservation
         fields = ('id', 'name', 'code', 'phone', 'alternative_phone', 'email', 'country', 'language',
@@ -114,41 +159,158 @@ class ReservationResource(resources.ModelResource):
                         'accept_safety_form', 'accept_disclaimer_form', 'accept_conduct_form')
 
 
-class ReservationAdmin(ImportExportModelAdmin):
+class ShowingDateListFilter(admin.SimpleListFilter):
+    '''
+    Filter the reservations on fixed ranges of their showing start time,
+    unlike date_hierarchy it doesn't need to aggregate the dates of all
+    the showings
+    '''
+    title = _('Showing Date')
+    parameter_name = 'showing_date'
+
+    def lookups(self, request, model_admin):
+        return (
+            ('today', _('Today')),
+            ('tomorrow', _('Tomorrow')),
+            ('next_7_days', _('Next 7 days')),
+            ('upcoming', _('Upcoming')),
+            ('past_7_days', _('Past 7 days')),
+            ('past', _('Past')),
+        )
+
+    def queryset(self, request, queryset):
+        now = datetime.now()
+        today = datetime.combine(now.date(), time.min)
+        ranges = {
+            'today': (today, today + timedelta(days=1)),
+            'tomorrow': (today + timedelta(days=1), today + timedelta(days=2)),
+            'next_7_days': (now, today + timedelta(days=8)),
+            'upcoming': (now, None),
+            'past_7_days': (today - timedelta(days=7), now),
+            'past': (None, now),
+        }
+        if self.value() not in ranges:
+            return queryset
+
+        start, end = ranges[self.value()]
+        if start is not None:
+            queryset = queryset.filter(showing__start_time__gte=start)
+        if end is not None:
+            queryset = queryset.filter(showing__start_time__lt=end)
+        return queryset
+
+
+class EstimatedCountMixin(object):
+    '''
+    Skip the exact counts of large changelists when
+    VISITS_ADMIN_ESTIMATED_COUNT is set
+    '''
+    paginator = EstimatedCountPaginator
+
+    @property
+    def show_full_result_count(self):
+        return not getattr(settings, 'VISITS_ADMIN_ESTIMATED_COUNT', False)
+
+
+class ReservationChangeList(ChangeList):
+    def get_results(self, request):
+        super(ReservationChangeList, self).get_results(request)
+        # The showings of the page are only formatted once
+        formatter = ShowingFormatter()
+        for reservation in self.result_list:
+            reservation.showing_date_time = formatter.format(reservation.showing)
+
+
+class ReservationAdmin(EstimatedCountMixin, ImportExportModelAdmin):
     list_display = ('email', 'name', 'activity_name', 'showing_date', 'showing_time', 'phone', 'n_spaces', 'code',
                     'vehicle_plate', 'language', 'created')
-    list_filter = ('showing__activity', 'showing__start_time', 'created')
+    list_filter = ('showing__activity', ShowingDateListFilter, 'created')
+    date_hierarchy = 'showing__start_time'
     ordering = ['showing__start_time']
     raw_id_fields = ('showing', )
-    date_hierarchy = 'showing__start_time'
+    form = ReservationAdminForm
     readonly_fields = ('code', 'created', 'last_modified')
-    search_fields = ('email', 'name')
+    search_fields = RESERVATION_SEARCH_FIELDS
     list_select_related = ('showing', 'language')
     resource_class = ReservationResource
+    # Uses showing_date_hierarchy rather than the date_hierarchy tag
+    change_list_template = 'admin/visits/reservation/change_list.html'
+
+    def get_queryset(self, request):
+        # Only the name of the activity is needed, not the whole row
+        return super(ReservationAdmin, self).get_queryset(request).annotate(
+            activity_name=F('showing__activity__name'))
+
+    def get_changelist(self, request, **kwargs):
+        return ReservationChangeList
 
     def showing_date(self, obj):
-        return obj.showing.start_time.strftime('%Y-%m-%d'),
+        return obj.showing_date_time[0]
     showing_date.short_description = _('Showing Date')
+    showing_date.admin_order_field = 'showing__start_time'
 
     def showing_time(self, obj):
-        if obj.showing.timezone:
-            return '{} {}'.format(obj.showing.start_date_tz.strftime('%I:%M %p'), obj.showing.get_timezone_abbr())
-        else:
-            return '{}'.format(obj.showing.start_date_tz.strftime('%I:%M %p %Z'))
+        return obj.showing_date_time[1]
     showing_time.short_description = _('Showing Time')
+    showing_time.admin_order_field = 'showing__start_time'
 
     def activity_name(self, obj):
-        return obj.showing.activity.name
+        return obj.activity_name
     activity_name.short_description = _('Activity Name')
+    activity_name.admin_order_field = 'activity_name'
+
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.model_name
+        urls = [
+            url(r'^export/stream/(?P<export_format>csv|xlsx)/$',
+                self.admin_site.admin_view(self.export_stream_view),
+                name='%s_%s_export_stream' % info),
+        ]
+        return urls + super(ReservationAdmin, self).get_urls()
 
+    def export_stream_view(self, request, export_format):
+        '''
+        Export the reservations of the changelist (with its filters), the
+        rows are streamed from the database to the response
+        '''
+        if not self.has_export_permission(request):
+            raise PermissionDenied
 
-class ShowingAdmin(dpadmin.DjangoplicityModelAdmin):
+        return export_response(
+            export_format,
+            RESERVATION_COLUMNS,
+            iter_reservation_rows(self.get_export_queryset(request)),
+            'Reservation-{}'.format(datetime.now().strftime('%Y-%m-%d')),
+        )
+
+
+class ShowingAdmin(EstimatedCountMixin, dpadmin.DjangoplicityModelAdmin):
     filter_horizontal = ('offered_languages', )
     list_display = ('activity', 'start_time', 'private', 'total_spaces', 'timezone', 'vehicle_plate_required',
                     'free_spaces', view_online, view_report)
     list_filter = ('activity', 'private', 'vehicle_plate_required')
     list_editable = ['vehicle_plate_required']
-    readonly_fields = ('free_spaces',)
+    list_select_related = ('activity', )
+    readonly_fields = ('free_spaces', 'booking_closes_at')
+
+
+class OutboxEmailAdmin(admin.ModelAdmin):
+    list_display = ('pk', 'kind', 'reservation', 'status', 'attempts', 'next_attempt', 'created', 'sent')
+    list_filter = ('status', 'kind')
+    raw_id_fields = ('reservation', )
+    readonly_fields = ('created', 'sent', 'last_error')
+    actions = ['retry']
+
+    def retry(self, request, queryset):
+        queryset.exclude(status=OutboxEmail.SENT).update(status=OutboxEmail.PENDING, next_attempt=timezone.now())
+    retry.short_description = _('Retry sending the selected emails')
+
+    def changelist_view(self, request, extra_context=None):
+        # Show the backlog on top of the list
+        extra_context = extra_context or {}
+        extra_context['title'] = _('Outbox: {pending} pending, {failed} failed').format(
+            **OutboxEmail.objects.backlog())
+        return super(OutboxEmailAdmin, self).changelist_view(request, extra_context)
 
 
 def register_with_admin(admin_site):
@@ -157,6 +319,7 @@ def register_with_admin(admin_site):
     admin_site.register(Language)
     admin_site.register(Reservation, ReservationAdmin)
     admin_site.register(Showing, ShowingAdmin)
+    admin_site.register(OutboxEmail, OutboxEmailAdmin)
 
 
 register_with_admin(admin.site)
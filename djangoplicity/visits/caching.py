@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+#
+# eso-visits
+# Copyright (c) 2007-2017, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#
+#    * Neither the name of the European Southern Observatory nor the names
+#      of its contributors may be used to endorse or promote products derived
+#      from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+
+from __future__ import unicode_literals
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+def get_showing_list_timeout():
+    return getattr(settings, 'VISITS_SHOWING_LIST_CACHE_TIMEOUT', 300)
+
+
+def _version_key(activity_pk):
+    return 'visits:showings:version:{}'.format(activity_pk)
+
+
+def _new_version():
+    # Based on the time rather than starting at 1, so a version evicted
+    # from the cache is never reused with stale entries still around
+    return int(time.time() * 1000)
+
+
+def get_showing_list_version(activity_pk):
+    '''
+    Return the current version of the showing list of the given activity
+    '''
+    key = _version_key(activity_pk)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _new_version(), None)
+        version = cache.get(key)
+    return version
+
+
+def bump_showing_list_version(activity_pk):
+    '''
+    Invalidate all the cached showing lists of the given activity
+    '''
+    key = _version_key(activity_pk)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, _new_version(), None)
+
+
+def get_showing_list_key(activity_pk, language):
+    return 'visits:showings:{}:{}:{}'.format(
+        activity_pk, language, get_showing_list_version(activity_pk))
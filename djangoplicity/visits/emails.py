@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+#
+# eso-visits
+# Copyright (c) 2007-2017, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#
+#    * Neither the name of the European Southern Observatory nor the names
+#      of its contributors may be used to endorse or promote products derived
+#      from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+
+
+from __future__ import unicode_literals
+from collections import OrderedDict
+import hashlib
+import threading
+
+import html2text
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.mail import EmailMultiAlternatives
+from django.template import TemplateDoesNotExist, loader
+from django.utils import translation
+from django.utils.encoding import force_bytes
+
+from djangoplicity.visits.models import Reservation, get_default_from_email
+
+
+_text_cache = OrderedDict()
+_text_cache_lock = threading.Lock()
+
+
+def html_to_text(html):
+    '''
+    Convert HTML to plain text with html2text. The results are kept in an
+    LRU cache of VISITS_EMAIL_TEXT_CACHE_SIZE entries keyed by a hash of
+    the HTML, as the same fragments come up in every email
+    '''
+    key = hashlib.sha1(force_bytes(html)).hexdigest()
+
+    with _text_cache_lock:
+        text = _text_cache.pop(key, None)
+        if text is not None:
+            _text_cache[key] = text
+            return text
+
+    text = html2text.html2text(html)
+
+    with _text_cache_lock:
+        _text_cache[key] = text
+        while len(_text_cache) > getattr(settings,
+                'VISITS_EMAIL_TEXT_CACHE_SIZE', 1000):
+            _text_cache.popitem(last=False)
+
+    return text
+
+
+def get_text_template(template_name):
+    '''
+    Return the plain text variant (.txt) of the given HTML email template,
+    or None if there isn't any or VISITS_EMAIL_TEXT_TEMPLATES is False
+    '''
+    if not getattr(settings, 'VISITS_EMAIL_TEXT_TEMPLATES', True):
+        return None
+
+    try:
+        return loader.get_template(
+            template_name.rsplit('.', 1)[0] + '.txt')
+    except TemplateDoesNotExist:
+        return None
+
+
+def get_base_context():
+    '''
+    Return the part of the email context common to all the reservations
+    '''
+    domain = Site.objects.get_current().domain
+    return {
+        'base_url': "{}://{}".format(getattr(settings, "URLS_SCHEME", "https"), domain),
+        'MEDIA_URL': settings.MEDIA_URL,
+        'STATIC_URL': settings.STATIC_URL,
+        'home': 'http://%s' % domain,
+    }
+
+
+def get_activity_context(reservation):
+    '''
+    Return the part of the email context which only depends on the activity
+    and the language of the reservation
+    '''
+    return {
+        'map_url': reservation.get_map_url(),
+    }
+
+
+class EmailRenderer(object):
+    '''
+    Render the emails of a given kind (see Reservation.EMAILS) for many
+    reservations: the template is only loaded once and the activity part of
+    the context is only computed once per activity and language.
+    The plain text body comes from the .txt variant of the template if
+    there is one, otherwise it is converted from the HTML
+    '''
+    def __init__(self, kind):
+        template_name, self.subject = Reservation.EMAILS[kind]
+        self.template = loader.get_template(template_name)
+        self.text_template = get_text_template(template_name)
+        self.base_context = get_base_context()
+        self.activity_contexts = {}
+
+    def get_context(self, reservation):
+        key = (reservation.showing.activity_id, reservation.language_id)
+        if key not in self.activity_contexts:
+            self.activity_contexts[key] = get_activity_context(reservation)
+
+        context = dict(self.base_context)
+        context.update(self.activity_contexts[key])
+        context['reservation'] = reservation
+        return context
+
+    def build_email(self, reservation):
+        '''
+        Render the email of the reservation in the current language, the
+        message is returned unsent
+        '''
+        context = self.get_context(reservation)
+        html_message = self.template.render(context)
+        if self.text_template is not None:
+            txt_message = self.text_template.render(context)
+        else:
+            txt_message = html_to_text(html_message)
+
+        message = EmailMultiAlternatives(
+            self.subject,
+            txt_message,
+            get_default_from_email(),
+            [reservation.email],
+        )
+        message.attach_alternative(html_message, 'text/html')
+
+        return message
+
+    def render(self, reservations):
+        '''
+        Yield (reservation, message) for each reservation, grouped by
+        language so that each language is only activated once
+        '''
+        by_language = OrderedDict()
+        for reservation in reservations:
+            by_language.setdefault(reservation.language_id, []).append(
+                reservation)
+
+        for language, group in by_language.items():
+            with translation.override(language):
+                for reservation in group:
+                    yield reservation, self.build_email(reservation)
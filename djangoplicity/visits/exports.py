@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+#
+# eso-visits
+# Copyright (c) 2007-2017, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#
+#    * Neither the name of the European Southern Observatory nor the names
+#      of its contributors may be used to endorse or promote products derived
+#      from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+
+
+from __future__ import unicode_literals
+import csv
+import tempfile
+from wsgiref.util import FileWrapper
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from django.utils import six
+from django.utils.encoding import force_text
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+import pytz
+
+# Columns of the reservations export, in the same order as the
+# ReservationResource export of the admin
+RESERVATION_COLUMNS = [
+    'id', 'showing', 'date', 'time', 'name', 'code', 'phone',
+    'alternative_phone', 'email', 'country', 'language', 'n_spaces',
+    'created', 'last_modified', 'vehicle_plate', 'accept_safety_form',
+    'accept_disclaimer_form', 'accept_conduct_form',
+]
+
+# Columns of the manifest of a showing: those of its report plus the
+# vehicle plate, checked at the gate
+MANIFEST_COLUMNS = [
+    'name', 'email', 'phone', 'alternative_phone', 'country', 'n_spaces',
+    'language', 'code', 'created', 'vehicle_plate',
+]
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Text starting with one of these could be run as a formula by spreadsheet
+# applications (CSV injection). Reservation fields are entered by visitors
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+class ShowingFormatter(object):
+    '''
+    Format the date and time of showings, once per showing, the pytz
+    timezones being only looked up once per timezone
+    '''
+    def __init__(self):
+        self.timezones = {}
+        self.showings = {}
+
+    def get_timezone(self, name):
+        if name not in self.timezones:
+            self.timezones[name] = pytz.timezone(name)
+        return self.timezones[name]
+
+    def format(self, showing):
+        '''
+        Return the date and the time with timezone of the showing
+        '''
+        if showing.pk not in self.showings:
+            tz = self.get_timezone(showing.timezone or settings.TIME_ZONE)
+            start_time = tz.localize(showing.start_time)
+            abbr = start_time.tzname()
+            # Same workaround as Showing.get_timezone_abbr()
+            if showing.timezone and abbr in ('-03', '-04'):
+                abbr = 'CLT'
+            self.showings[showing.pk] = (
+                start_time.strftime('%Y-%m-%d'),
+                '{} {}'.format(start_time.strftime('%I:%M %p'), abbr),
+            )
+        return self.showings[showing.pk]
+
+
+def iter_reservation_rows(queryset):
+    '''
+    Yield the rows of the export of the given reservations, streamed from
+    the database
+    '''
+    formatter = ShowingFormatter()
+    reservations = queryset.select_related('showing__activity').order_by(
+        'showing__start_time', 'pk')
+
+    for reservation in reservations.iterator():
+        showing = reservation.showing
+        showing_date, showing_time = formatter.format(showing)
+        yield [
+            reservation.pk,
+            showing.activity.name,
+            showing_date,
+            showing_time,
+            reservation.name,
+            reservation.code,
+            reservation.phone,
+            reservation.alternative_phone,
+            reservation.email,
+            reservation.country,
+            reservation.language_id,
+            reservation.n_spaces,
+            reservation.created.strftime(DATETIME_FORMAT),
+            reservation.last_modified.strftime(DATETIME_FORMAT),
+            reservation.vehicle_plate,
+            int(reservation.accept_safety_form),
+            int(reservation.accept_disclaimer_form),
+            int(reservation.accept_conduct_form),
+        ]
+
+
+def iter_manifest_rows(queryset):
+    '''
+    Yield the rows of the manifest of a showing from its reservations, in
+    the order of the showing report, streamed from the database. The
+    creation dates are in DATETIME_FORMAT so they can be sorted
+    '''
+    reservations = queryset.select_related('language').order_by(
+        'created', 'pk')
+
+    for reservation in reservations.iterator():
+        yield [
+            reservation.name,
+            reservation.email,
+            reservation.phone,
+            reservation.alternative_phone,
+            reservation.country,
+            reservation.n_spaces,
+            reservation.language.name,
+            reservation.code,
+            reservation.created.strftime(DATETIME_FORMAT),
+            reservation.vehicle_plate,
+        ]
+
+
+class Echo(object):
+    '''
+    File-like object which returns what is written, for csv.writer
+    '''
+    def write(self, value):
+        return value
+
+
+def _is_formula(value):
+    return isinstance(value, six.string_types) and \
+        value.startswith(FORMULA_PREFIXES)
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if _is_formula(value):
+        value = "'" + value
+    value = force_text(value)
+    # The Python 2 csv module only handles bytes
+    return value.encode('utf-8') if six.PY2 else value
+
+
+def csv_response(header, rows, filename):
+    '''
+    Return a response streaming the rows as CSV
+    '''
+    writer = csv.writer(Echo())
+
+    def content():
+        yield writer.writerow([_csv_value(value) for value in header])
+        for row in rows:
+            yield writer.writerow([_csv_value(value) for value in row])
+
+    response = StreamingHttpResponse(content(),
+        content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = 'attachment; filename="{}"'.format(
+        filename)
+    return response
+
+
+def _xlsx_value(sheet, value):
+    if _is_formula(value):
+        # Written as a text cell rather than a formula
+        cell = WriteOnlyCell(sheet, value=value)
+        cell.data_type = 's'
+        return cell
+    return value
+
+
+def xlsx_response(header, rows, filename):
+    '''
+    Return a response with the rows as an XLSX workbook. The workbook is
+    written row by row to a temporary file which is then streamed
+    '''
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(header)
+    for row in rows:
+        sheet.append([_xlsx_value(sheet, value) for value in row])
+
+    output = tempfile.TemporaryFile()
+    workbook.save(output)
+    size = output.tell()
+    output.seek(0)
+
+    response = StreamingHttpResponse(FileWrapper(output),
+        content_type='application/vnd.openxmlformats-officedocument.'
+        'spreadsheetml.sheet')
+    response['Content-Disposition'] = 'attachment; filename="{}"'.format(
+        filename)
+    response['Content-Length'] = size
+    return response
+
+
+EXPORT_FORMATS = {
+    'csv': csv_response,
+    'xlsx': xlsx_response,
+}
+
+
+def export_response(export_format, header, rows, filename):
+    '''
+    Return the response of the export of the rows in the given format
+    (csv or xlsx), filename is without extension
+    '''
+    return EXPORT_FORMATS[export_format](header, rows,
+        '{}.{}'.format(filename, export_format))
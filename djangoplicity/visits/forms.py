@@ -29,12 +29,16 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE
 
+import copy
+
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Submit
 from django import forms
+from django.db import transaction
 from django.utils.translation import gettext_lazy as _
 from django.conf import Settings, settings
-from djangoplicity.visits.models import Reservation
+from djangoplicity.visits.models import Activity, Reservation, Showing, \
+    SpacesUnavailable
 
 
 NOT_HAS_SYMPTOMS_LABEL = _("I declare that no one in my group has tested positive for COVID-19 or had any symptoms in "
@@ -191,3 +195,63 @@ class ReservationForm(forms.ModelForm):
                         number=self.showing.free_spaces))
 
         return n_spaces
+
+    def add_spaces_unavailable_error(self, free_spaces):
+        '''
+        Report that the seats couldn't be allocated when the reservation
+        was saved, e.g. because another booking took them in the meantime
+        '''
+        self.add_error('n_spaces', _('Only {number} spaces are '
+            'currently available').format(number=free_spaces))
+
+
+class ReservationAdminForm(forms.ModelForm):
+    '''
+    Reservation form of the admin, a showing without enough free spaces is
+    reported on n_spaces instead of failing when the reservation is saved
+    '''
+    class Meta:
+        model = Reservation
+        fields = '__all__'
+
+    def clean(self):
+        cleaned_data = super(ReservationAdminForm, self).clean()
+        showing = cleaned_data.get('showing')
+        n_spaces = cleaned_data.get('n_spaces')
+        if showing is None or n_spaces is None:
+            return cleaned_data
+
+        # Allocate the spaces as Reservation.save() will, then roll back
+        reservation = copy.copy(self.instance)
+        reservation.showing = Showing(pk=showing.pk)
+        reservation.n_spaces = n_spaces
+        try:
+            with transaction.atomic():
+                reservation.allocate_spaces()
+                transaction.set_rollback(True)
+        except SpacesUnavailable as e:
+            self.add_error('n_spaces', _('Only {number} spaces are '
+                'currently available').format(number=e.free_spaces))
+
+        return cleaned_data
+
+
+class ShowingReportFilterForm(forms.Form):
+    '''
+    Filters of the showing reports list, all optional
+    '''
+    UPCOMING = 'upcoming'
+    PAST = 'past'
+
+    q = forms.CharField(label=_('Search'), required=False)
+    activity = forms.ModelChoiceField(
+        label=_('Activity'),
+        queryset=Activity.objects.filter(source__isnull=True).order_by('name'),
+        required=False)
+    start_date = forms.DateField(label=_('From'), required=False)
+    end_date = forms.DateField(label=_('To'), required=False)
+    when = forms.ChoiceField(label=_('When'), required=False, choices=(
+        ('', _('All')),
+        (UPCOMING, _('Upcoming')),
+        (PAST, _('Past')),
+    ))
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+#
+# eso-visits
+# Copyright (c) 2007-2017, European Southern Observatory (ESO)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#
+#    * Neither the name of the European Southern Observatory nor the names
+#      of its contributors may be used to endorse or promote products derived
+#      from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY ESO ``AS IS'' AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL ESO BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE
+
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+from django.db.models import Sum, Value
+from django.db.models.functions import Coalesce
+
+from djangoplicity.visits.models import Showing
+
+
+class Command(BaseCommand):
+    help = 'Recompute the free spaces of the showings from their reservations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('showing_ids', nargs='*', type=int,
+            help='Only reconcile these showings (default: all)')
+        parser.add_argument('--dry-run', action='store_true', default=False,
+            help='Only report the showings with a wrong number of free spaces')
+
+    def handle(self, *args, **options):
+        showings = Showing.objects.all()
+        if options['showing_ids']:
+            showings = showings.filter(pk__in=options['showing_ids'])
+
+        drifted = [
+            (pk, free_spaces, total_spaces - reserved)
+            for pk, free_spaces, total_spaces, reserved in showings.annotate(
+                reserved=Coalesce(Sum('reservation__n_spaces'), Value(0))
+            ).values_list('pk', 'free_spaces', 'total_spaces', 'reserved')
+            if free_spaces != total_spaces - reserved
+        ]
+
+        for pk, free_spaces, expected in drifted:
+            self.stdout.write('Showing {}: {} free spaces, expected {}'.format(
+                pk, free_spaces, expected))
+
+        if options['dry_run']:
+            return
+
+        showings.reconcile_free_spaces()
+        self.stdout.write('Reconciled {} showing(s)'.format(len(drifted)))
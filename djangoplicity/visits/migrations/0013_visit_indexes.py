@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+# Partial indexes, supported by PostgreSQL and SQLite
+PARTIAL_INDEXES = [
+    ('visits_reservation_code_uniq',
+     'CREATE UNIQUE INDEX visits_reservation_code_uniq '
+     'ON visits_reservation (code) WHERE code <> \'\''),
+    ('visits_showing_public_start',
+     'CREATE INDEX visits_showing_public_start '
+     'ON visits_showing (activity_id, start_time) WHERE NOT private'),
+]
+
+
+def create_partial_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor in ('postgresql', 'sqlite'):
+        for dummy_name, sql in PARTIAL_INDEXES:
+            schema_editor.execute(sql)
+    else:
+        schema_editor.execute(
+            'CREATE INDEX visits_reservation_code_uniq '
+            'ON visits_reservation (code)')
+
+
+def drop_partial_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor in ('postgresql', 'sqlite'):
+        for name, dummy_sql in PARTIAL_INDEXES:
+            schema_editor.execute('DROP INDEX {}'.format(name))
+    else:
+        schema_editor.execute(
+            'DROP INDEX visits_reservation_code_uniq ON visits_reservation')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visits', '0012_showing_vehicle_plate_required'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(fields=['showing', 'email'], name='visits_reserv_showing_email'),
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(fields=['last_modified'], name='visits_reserv_last_modified'),
+        ),
+        migrations.AddIndex(
+            model_name='showing',
+            index=models.Index(fields=['activity', 'private', 'start_time'], name='visits_showing_act_priv_start'),
+        ),
+        migrations.AddIndex(
+            model_name='showing',
+            index=models.Index(fields=['start_time'], name='visits_showing_start_time'),
+        ),
+        migrations.RunPython(create_partial_indexes, drop_partial_indexes),
+    ]
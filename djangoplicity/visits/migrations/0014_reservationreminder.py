@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visits', '0013_visit_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReservationReminder',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('upcoming', 'Upcoming visit'), ('modified', 'Reservation modified')], max_length=10)),
+                ('sent', models.DateTimeField(default=django.utils.timezone.now)),
+                ('reservation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reminders', to='visits.Reservation')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='reservationreminder',
+            index=models.Index(fields=['reservation', 'kind', 'sent'], name='visits_reminder_res_kind_sent'),
+        ),
+    ]
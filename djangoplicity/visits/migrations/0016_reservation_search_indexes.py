@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import warnings
+
+from django.db import DatabaseError, migrations
+
+
+# Trigram indexes for the "icontains" lookups of the reservation search,
+# which Django turns into UPPER("column"::text) LIKE UPPER(%s). They are
+# built CONCURRENTLY so the reservations stay writable meanwhile, which
+# can't be done in a transaction
+SEARCH_INDEXES = [
+    ('visits_reserv_{}_trgm'.format(column),
+     'CREATE INDEX CONCURRENTLY IF NOT EXISTS visits_reserv_{0}_trgm ON visits_reservation '
+     'USING gin (UPPER({0}::text) gin_trgm_ops)'.format(column))
+    for column in ['email', 'name', 'phone', 'code', 'vehicle_plate']
+]
+
+
+def has_pg_trgm(schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        if cursor.fetchone():
+            return True
+        try:
+            cursor.execute('CREATE EXTENSION pg_trgm')
+        except DatabaseError:
+            # Creating an extension usually needs a superuser
+            return False
+    return True
+
+
+def create_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    if not has_pg_trgm(schema_editor):
+        warnings.warn('The pg_trgm extension is not installed and could not '
+            'be created, the reservation search indexes were skipped. Run '
+            '"CREATE EXTENSION pg_trgm" as a superuser, then migrate visits '
+            'back to 0015 and forward again to create them.')
+        return
+    for dummy_name, sql in SEARCH_INDEXES:
+        schema_editor.execute(sql)
+
+
+def drop_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        for name, dummy_sql in SEARCH_INDEXES:
+            schema_editor.execute(
+                'DROP INDEX CONCURRENTLY IF EXISTS {}'.format(name))
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('visits', '0015_outboxemail'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+import pytz
+
+
+def get_booking_closes_at(start_time, timezone_name, latest_reservation_time):
+    # Frozen copy of models.get_booking_closes_at() with the default
+    # VISITS_BOOKING_CUTOFF_TIME, saving an activity applies the current rule
+    tz = pytz.timezone(timezone_name or settings.TIME_ZONE)
+    if timezone.is_aware(start_time):
+        start_time = timezone.make_naive(start_time, tz)
+
+    closes_at = start_time - timedelta(hours=latest_reservation_time)
+    closes_at = min(datetime.combine(closes_at.date(), time(13)), closes_at)
+
+    return timezone.make_naive(tz.localize(closes_at),
+        pytz.timezone(settings.TIME_ZONE))
+
+
+def compute_booking_closes_at(apps, schema_editor):
+    Showing = apps.get_model('visits', 'Showing')
+    for pk, start_time, timezone_name, hours in Showing.objects.values_list(
+            'pk', 'start_time', 'timezone',
+            'activity__latest_reservation_time').iterator():
+        Showing.objects.filter(pk=pk).update(
+            booking_closes_at=get_booking_closes_at(start_time,
+                timezone_name, hours))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('visits', '0016_reservation_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='showing',
+            name='booking_closes_at',
+            field=models.DateTimeField(blank=True, editable=False, help_text='When the bookings close (server time), computed from the activity and the showing timezone', null=True),
+        ),
+        migrations.AddIndex(
+            model_name='showing',
+            index=models.Index(fields=['activity', 'private', 'booking_closes_at'], name='visits_showing_act_priv_close'),
+        ),
+        migrations.RunPython(compute_booking_closes_at, migrations.RunPython.noop),
+    ]
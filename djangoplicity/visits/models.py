@@ -31,17 +31,20 @@
 
 from __future__ import unicode_literals
 from __future__ import print_function
+from datetime import datetime, time, timedelta
+import json
+import operator
 import os
 import sys
+from functools import reduce
 import pytz
 from hashids import Hashids
-import html2text
 from django.conf import settings
-from django.core.mail import send_mail
-from django.db import models, transaction
-from django.db.models import Sum
+from django.db import connection, models, transaction
+from django.db.models import Case, Count, Exists, F, FloatField, \
+    IntegerField, Min, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Cast, Coalesce
 from django.db.models.signals import post_delete, post_save
-from django.template import loader
 from django.urls import reverse
 from django.utils import timezone, translation
 from django.utils.translation import gettext_lazy as _
@@ -50,8 +53,8 @@ from djangoplicity.media.models import Image
 from djangoplicity.metadata.archives import fields as metadatafields
 from djangoplicity.translation.fields import TranslationForeignKey
 from djangoplicity.translation.models import TranslationModel, translation_reverse
-from django.contrib.sites.models import Site
 from djangoplicity.products2.models import TechnicalDocument
+from djangoplicity.visits.caching import bump_showing_list_version
 
 
 def eprint(*args, **kwargs):
@@ -81,6 +84,52 @@ def get_default_from_email():
 
 TIMEZONES_TZS = [(tz, tz) for tz in pytz.all_timezones]
 
+_hashids = None
+
+
+def get_hashids():
+    '''
+    Return the Hashids encoder for the reservation codes, it is only built
+    once per process
+    '''
+    global _hashids
+    if _hashids is None:
+        _hashids = Hashids(alphabet=settings.HASHIDS_ALPHABET,
+            salt=settings.HASHIDS_SALT, min_length=5)
+    return _hashids
+
+
+def generate_code(pk):
+    '''
+    Return the reservation code for the given reservation PK
+    '''
+    return get_hashids().encode(pk)
+
+
+def next_reservation_ids(count=1):
+    '''
+    Take the next <count> values from the reservation PK sequence, so the
+    code can be generated before the INSERT (PostgreSQL only)
+    '''
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT nextval(pg_get_serial_sequence(%s, %s)) '
+            'FROM generate_series(1, %s)',
+            [Reservation._meta.db_table, Reservation._meta.pk.column, count])
+        return [row[0] for row in cursor.fetchall()]
+
+
+class SpacesUnavailable(Exception):
+    '''
+    Raised when a showing doesn't have enough free spaces left for a
+    reservation
+    '''
+    def __init__(self, free_spaces):
+        super(SpacesUnavailable, self).__init__(
+            'Only {} spaces are currently available'.format(free_spaces))
+        self.free_spaces = free_spaces
+
+
 class Activity(TranslationModel):
     id = metadatafields.AVMIdField(primary_key=True, verbose_name='ID',
         help_text='ID of the activity, also used in URLs')
@@ -175,6 +224,113 @@ class Language(models.Model):
         ordering = ['name']
 
 
+# Reservation fields searched by the admin and the reports, they have
+# trigram indexes on PostgreSQL
+RESERVATION_SEARCH_FIELDS = ['email', 'name', 'phone', 'code', 'vehicle_plate']
+
+
+class ReservationQuerySet(models.QuerySet):
+    def for_email(self):
+        '''
+        Load everything needed to render the reservation emails in the same
+        query
+        '''
+        return self.select_related('showing__activity', 'language')
+
+    def pending_reminders(self, upcoming_range=None, modified_range=None):
+        '''
+        Return the reservations starting in upcoming_range which didn't get
+        an "upcoming" reminder yet, or modified in modified_range which
+        didn't get a "modified" reminder since. Ranges are (from, to)
+        datetimes, to excluded. Each reservation is only returned once,
+        annotated with reminded_upcoming and reminded_modified
+        '''
+        reminders = ReservationReminder.objects.filter(
+            reservation=OuterRef('pk'))
+        queryset = self.annotate(
+            reminded_upcoming=Exists(reminders.filter(
+                kind=ReservationReminder.UPCOMING)),
+            reminded_modified=Exists(reminders.filter(
+                kind=ReservationReminder.MODIFIED,
+                sent__gte=OuterRef('last_modified'))),
+        )
+
+        due = []
+        if upcoming_range:
+            due.append(Q(
+                showing__start_time__gte=upcoming_range[0],
+                showing__start_time__lt=upcoming_range[1],
+                reminded_upcoming=False,
+            ))
+        if modified_range:
+            due.append(Q(
+                last_modified__gte=modified_range[0],
+                last_modified__lt=modified_range[1],
+                reminded_modified=False,
+            ))
+
+        if not due:
+            return self.none()
+        return queryset.filter(reduce(operator.or_, due))
+
+    def search(self, query):
+        '''
+        Return the reservations matching all the words of query, each word
+        can be a part of any of RESERVATION_SEARCH_FIELDS. The lookups are
+        case insensitive, as the trigram indexes on PostgreSQL
+        '''
+        queryset = self
+        for word in query.split():
+            queryset = queryset.filter(reduce(operator.or_, [
+                Q(**{'{}__icontains'.format(name): word})
+                for name in RESERVATION_SEARCH_FIELDS
+            ]))
+        return queryset
+
+    def bulk_reserve(self, reservations, batch_size=500):
+        '''
+        Insert new reservations with a PK and a code in bulk. The capacity
+        of all their showings is checked first and their free spaces are
+        only updated once per showing at the end. Raises SpacesUnavailable
+        if a showing doesn't have enough free spaces left for its
+        reservations
+        '''
+        spaces = {}
+        for reservation in reservations:
+            spaces[reservation.showing_id] = spaces.get(
+                reservation.showing_id, 0) + reservation.n_spaces
+
+        with transaction.atomic():
+            # Lock the showings so that no other reservation can take the
+            # spaces before the new ones are inserted
+            showings = Showing.objects.select_for_update().filter(
+                pk__in=spaces).values_list('pk', 'free_spaces', 'activity_id')
+            activity_pks = set()
+            for showing_pk, free_spaces, activity_pk in showings:
+                if spaces[showing_pk] > free_spaces:
+                    raise SpacesUnavailable(free_spaces)
+                activity_pks.add(activity_pk)
+
+            now = timezone.now()
+            for reservation in reservations:
+                reservation.last_modified = now
+
+            self.bulk_create(reservations, batch_size=batch_size)
+
+            # The capacity was checked under the locks, so only take the
+            # spaces, rather than recomputing them as reconcile_free_spaces()
+            # which locks the reservations table (and would deadlock with a
+            # concurrent cancellation)
+            for showing_pk, n_spaces in spaces.items():
+                Showing.objects.filter(pk=showing_pk).update(
+                    free_spaces=F('free_spaces') - n_spaces)
+
+            # bulk_create() doesn't send post_save
+            for activity_pk in activity_pks:
+                transaction.on_commit(
+                    lambda pk=activity_pk: bump_showing_list_version(pk))
+
+
 class Reservation(models.Model):
     code = models.CharField(max_length=50, blank=True)
     showing = models.ForeignKey('Showing')
@@ -195,33 +351,56 @@ class Reservation(models.Model):
     accept_disclaimer_form = models.BooleanField(verbose_name=_('Accept Disclaimer Form'), default=False)
     accept_conduct_form = models.BooleanField(verbose_name=_('Accept Conduct Form'), default=False)
 
+    objects = ReservationQuerySet.as_manager()
+
+    # Template and subject of the emails sent about a reservation
+    EMAILS = {
+        'confirmation': ('visits/emails/reservation-confirm.html',
+            _('Reservation confirmation')),
+        'reminder': ('visits/emails/reservation-reminder.html',
+            _('Reservation reminder')),
+        'deleted': ('visits/emails/reservation-deleted.html',
+            _('Reservation deleted')),
+        'updated': ('visits/emails/reservation-updated.html',
+            _('Reservation updated')),
+    }
+
     def __unicode__(self):
         return '{}, {} ({} spaces)'.format(self.email, self.showing,
             self.n_spaces)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['showing', 'email'],
+                name='visits_reserv_showing_email'),
+            models.Index(fields=['last_modified'],
+                name='visits_reserv_last_modified'),
+        ]
+
+    def get_tech_doc_url(self, name):
+        '''
+        Return the PDF URL of the given activity technical document
+        (e.g. 'safety_tech_doc'), in Spanish if it is the reservation
+        language and the Spanish version exists
+        '''
+        activity = self.showing.activity
+        if self.language_id == 'es':
+            doc = getattr(activity, name + '_es')
+            if doc and doc.resource_pdf:
+                return doc.resource_pdf.absolute_url
+        doc = getattr(activity, name)
+        if doc and doc.resource_pdf:
+            return doc.resource_pdf.absolute_url
+        return '#'
+
     def get_safety_tech_doc_url(self):
-        if self.language.code == 'es' and self.showing.activity.safety_tech_doc_es and self.showing.activity.safety_tech_doc_es.resource_pdf:
-            return self.showing.activity.safety_tech_doc_es.resource_pdf.absolute_url
-        elif self.showing.activity.safety_tech_doc and self.showing.activity.safety_tech_doc.resource_pdf:
-            return self.showing.activity.safety_tech_doc.resource_pdf.absolute_url
-        else:
-            return '#'
+        return self.get_tech_doc_url('safety_tech_doc')
 
     def get_conduct_tech_doc_url(self):
-        if self.language.code == 'es' and self.showing.activity.conduct_tech_doc_es and self.showing.activity.conduct_tech_doc_es.resource_pdf:
-            return self.showing.activity.conduct_tech_doc_es.resource_pdf.absolute_url
-        elif self.showing.activity.conduct_tech_doc and self.showing.activity.conduct_tech_doc.resource_pdf:
-            return self.showing.activity.conduct_tech_doc.resource_pdf.absolute_url
-        else:
-            return '#'
+        return self.get_tech_doc_url('conduct_tech_doc')
 
     def get_liability_tech_doc_url(self):
-        if self.language.code == 'es' and self.showing.activity.liability_tech_doc_es and self.showing.activity.liability_tech_doc_es.resource_pdf:
-            return self.showing.activity.liability_tech_doc_es.resource_pdf.absolute_url
-        elif self.showing.activity.liability_tech_doc and self.showing.activity.liability_tech_doc.resource_pdf:
-            return self.showing.activity.liability_tech_doc.resource_pdf.absolute_url
-        else:
-            return '#'
+        return self.get_tech_doc_url('liability_tech_doc')
 
     def get_map_url(self):
         if self.showing.activity.map_url:
@@ -231,105 +410,338 @@ class Reservation(models.Model):
 
     @classmethod
     def delete_notification(cls, sender, instance, **kwargs):
-        transaction.on_commit(instance.showing.update_spaces_count)
+        # Reservation.delete() gives the spaces back itself, once it knows
+        # the row was actually deleted
+        if getattr(instance, '_deleting', False):
+            return
+        # post_delete is sent inside the deletion transaction, so the spaces
+        # are given back atomically with the delete
+        instance.showing.allocate_spaces(-instance.n_spaces)
+
+    def delete(self, **kwargs):
+        '''
+        Delete the reservation and give its spaces back to the showing, only
+        if the row was still there: post_delete is also sent when a
+        concurrent cancellation deleted it first
+        '''
+        with transaction.atomic():
+            self._deleting = True
+            try:
+                deleted = super(Reservation, self).delete(**kwargs)
+            finally:
+                self._deleting = False
+            if deleted[1].get(self._meta.label):
+                self.showing.allocate_spaces(-self.n_spaces)
+        return deleted
 
     def get_absolute_url(self):
         return reverse('visits-reservation-update', args=[self.code])
 
     def save(self, **kwargs):
         self.last_modified = timezone.now()
-        super(Reservation, self).save(**kwargs)
-        transaction.on_commit(self.showing.update_spaces_count)
+        with transaction.atomic():
+            self.allocate_spaces()
+
+            if self.pk is None and not self.code and \
+                    connection.vendor == 'postgresql':
+                # Take the PK from the sequence so that the code is written
+                # by the INSERT itself
+                self.pk = next_reservation_ids()[0]
+                self.code = generate_code(self.pk)
+                kwargs['force_insert'] = True
+
+            super(Reservation, self).save(**kwargs)
+
+            if not self.code:
+                # The PK is only known after the INSERT, we use "update" so
+                # as not to go through save() and the signals again
+                self.code = generate_code(self.pk)
+                Reservation.objects.filter(pk=self.pk).update(code=self.code)
+
+    def allocate_spaces(self):
+        '''
+        Reserve the spaces needed by this reservation on its showing, taking
+        into account what was already reserved if the reservation exists.
+        Must be called inside a transaction, raises SpacesUnavailable if
+        the showing doesn't have enough free spaces left
+        '''
+        previous = None
+        if self.pk:
+            # Lock the row so concurrent updates of the same reservation
+            # don't both compute their delta from the same old value
+            previous = Reservation.objects.select_for_update().filter(
+                pk=self.pk).values('showing_id', 'n_spaces').first()
+
+        if previous is None:
+            self.showing.allocate_spaces(self.n_spaces)
+        elif previous['showing_id'] != self.showing_id:
+            Showing(pk=previous['showing_id']).allocate_spaces(
+                -previous['n_spaces'])
+            self.showing.allocate_spaces(self.n_spaces)
+        else:
+            self.showing.allocate_spaces(
+                self.n_spaces - previous['n_spaces'])
 
     def get_context(self):
-        return {
-            'base_url': "{}://{}".format(getattr(settings, "URLS_SCHEME", "https"), Site.objects.get_current().domain),
-            'MEDIA_URL': settings.MEDIA_URL,
-            'STATIC_URL': settings.STATIC_URL,
-            'reservation': self,
-            'home': 'http://%s' % Site.objects.get_current().domain,
-        }
+        from djangoplicity.visits.emails import get_activity_context, \
+            get_base_context
 
-    def send_confirmation_email(self):
-        template = loader.get_template('visits/emails/reservation-confirm.html')
-        translation.activate(self.language.code)
-
-        html_message = template.render(self.get_context())
-        txt_message = html2text.html2text(html_message)
-
-        #  print('DEBUG')
-        #  print(_('Reservation confirmation'))
-        #  print(html_message)
-        #  print('DEBUG')
-
-        send_mail(
-            _('Reservation confirmation'),
-            txt_message,
-            get_default_from_email(),
-            [self.email],
-            html_message=html_message,
-        )
+        context = get_base_context()
+        context.update(get_activity_context(self))
+        context['reservation'] = self
+        return context
+
+    def build_email(self, kind):
+        '''
+        Render the email of the given kind (see EMAILS) in the reservation
+        language, the message is returned unsent. To render many emails
+        use emails.EmailRenderer
+        '''
+        from djangoplicity.visits.emails import EmailRenderer
+
+        with translation.override(self.language_id):
+            return EmailRenderer(kind).build_email(self)
 
-        translation.deactivate()
+    def send_email(self, kind):
+        self.build_email(kind).send()
+
+    def send_confirmation_email(self):
+        self.send_email('confirmation')
 
     def send_reminder_email(self):
-        template = loader.get_template('visits/emails/reservation-reminder.html')
+        self.send_email('reminder')
 
-        translation.activate(self.language.code)
+    def send_deleted_email(self):
+        self.send_email('deleted')
 
-        html_message = template.render(self.get_context())
-        txt_message = html2text.html2text(html_message)
+    def send_updated_email(self):
+        self.send_email('updated')
 
-        #  print('DEBUG')
-        #  print(_('Reservation reminder'))
-        #  print(html_message)
-        #  print('DEBUG')
 
-        send_mail(
-            _('Reservation reminder'),
-            txt_message,
-            get_default_from_email(),
-            [self.email],
-            html_message=html_message,
-        )
+class ReservationReminder(models.Model):
+    '''
+    Reminder sent for a reservation, so that the same reminder isn't sent
+    twice
+    '''
+    UPCOMING = 'upcoming'
+    MODIFIED = 'modified'
+    KIND_CHOICES = (
+        (UPCOMING, 'Upcoming visit'),
+        (MODIFIED, 'Reservation modified'),
+    )
+
+    reservation = models.ForeignKey(Reservation, on_delete=models.CASCADE,
+        related_name='reminders')
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    sent = models.DateTimeField(default=timezone.now)
 
-        translation.deactivate()
+    def __unicode__(self):
+        return '{} reminder for {}'.format(self.kind, self.reservation_id)
 
-    def send_deleted_email(self):
-        template = loader.get_template('visits/emails/reservation-deleted.html')
+    class Meta:
+        indexes = [
+            models.Index(fields=['reservation', 'kind', 'sent'],
+                name='visits_reminder_res_kind_sent'),
+        ]
 
-        translation.activate(self.language.code)
 
-        html_message = template.render(self.get_context())
-        txt_message = html2text.html2text(html_message)
+class OutboxEmailQuerySet(models.QuerySet):
+    def due(self):
+        '''
+        Return the pending emails which should be sent now
+        '''
+        return self.filter(status=OutboxEmail.PENDING,
+            next_attempt__lte=timezone.now())
 
-        send_mail(
-            _('Reservation deleted'),
-            txt_message,
-            get_default_from_email(),
-            [self.email],
-            html_message=html_message,
-        )
+    def backlog(self):
+        '''
+        Return the number of pending and failed emails and the creation date
+        of the oldest pending one
+        '''
+        backlog = self.filter(status=OutboxEmail.PENDING).aggregate(
+            pending=Count('pk'), oldest=Min('created'))
+        backlog['failed'] = self.filter(status=OutboxEmail.FAILED).count()
+        return backlog
 
-        translation.deactivate()
 
-    def send_updated_email(self):
-        template = loader.get_template('visits/emails/reservation-updated.html')
+class OutboxEmail(models.Model):
+    '''
+    Email about a reservation waiting to be sent. It is written in the same
+    transaction as the reservation change, so no email is lost if sending
+    fails or the worker crashes
+    '''
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    )
+
+    kind = models.CharField(max_length=20)
+    reservation = models.ForeignKey(Reservation, blank=True, null=True,
+        on_delete=models.SET_NULL, related_name='+')
+    reservation_data = models.TextField(blank=True,
+        help_text='Fields of the reservation if it was deleted (JSON)')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+        default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(default=timezone.now)
+    sent = models.DateTimeField(blank=True, null=True)
 
-        translation.activate(self.language.code)
+    objects = OutboxEmailQuerySet.as_manager()
 
-        html_message = template.render(self.get_context())
-        txt_message = html2text.html2text(html_message)
+    def __unicode__(self):
+        return '{} email ({})'.format(self.kind, self.status)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt'],
+                name='visits_outbox_status_next'),
+        ]
+
+    @classmethod
+    def queue(cls, reservation, kind):
+        '''
+        Add the email of the given kind for the reservation to the outbox
+        '''
+        if kind == 'deleted':
+            # The reservation will be gone when the email is sent, so keep
+            # what is needed to render it
+            data = {
+                field.attname: field.value_from_object(reservation)
+                for field in Reservation._meta.concrete_fields
+                if field.name not in ('created', 'last_modified')
+            }
+            return cls.objects.create(kind=kind,
+                reservation_data=json.dumps(data))
+
+        return cls.objects.create(kind=kind, reservation=reservation)
+
+    def get_reservation(self):
+        '''
+        Return the reservation to render the email with, None if it has
+        been deleted in the meantime
+        '''
+        if self.reservation_data:
+            return Reservation(**json.loads(self.reservation_data))
+        return self.reservation
+
+    def record_failure(self, error, retry=True):
+        '''
+        Schedule the next attempt with an exponential backoff, or give up
+        after VISITS_OUTBOX_MAX_ATTEMPTS attempts
+        '''
+        self.attempts += 1
+        self.last_error = '{}'.format(error)
+        if not retry or self.attempts >= getattr(settings,
+                'VISITS_OUTBOX_MAX_ATTEMPTS', 5):
+            self.status = self.FAILED
+        else:
+            delay = min(60 * 2 ** (self.attempts - 1), 3600)
+            self.next_attempt = timezone.now() + timedelta(seconds=delay)
+        self.save()
+
+
+def get_booking_closes_at(start_time, timezone_name, latest_reservation_time):
+    '''
+    Return when the bookings close for a showing starting at start_time in
+    the timezone timezone_name, as a naive datetime in the server timezone.
+    Bookings close latest_reservation_time hours before the start, at the
+    VISITS_BOOKING_CUTOFF_TIME of that day unless the setting is None. They
+    never close later than latest_reservation_time hours before the start
+    '''
+    tz = pytz.timezone(timezone_name or settings.TIME_ZONE)
+    if timezone.is_aware(start_time):
+        start_time = timezone.make_naive(start_time, tz)
+
+    closes_at = start_time - timedelta(hours=latest_reservation_time)
+    cutoff = getattr(settings, 'VISITS_BOOKING_CUTOFF_TIME', time(13))
+    if cutoff is not None:
+        # The cutoff of the day can be after the deadline, e.g. for a
+        # morning showing or a short latest_reservation_time
+        closes_at = min(datetime.combine(closes_at.date(), cutoff), closes_at)
+
+    return timezone.make_naive(tz.localize(closes_at),
+        pytz.timezone(settings.TIME_ZONE))
+
+
+class ShowingQuerySet(models.QuerySet):
+
+    def bookable(self):
+        '''
+        Return the showings which still accept bookings, as
+        Showing.is_booking_closed(): those without booking_closes_at are open
+        '''
+        return self.filter(Q(booking_closes_at__isnull=True) |
+            Q(booking_closes_at__gt=timezone.now()))
 
-        send_mail(
-            _('Reservation updated'),
-            txt_message,
-            get_default_from_email(),
-            [self.email],
-            html_message=html_message,
+    def update_booking_closes_at(self):
+        '''
+        Recompute booking_closes_at for the showings in the queryset, e.g.
+        after the reservation policy of their activity changed. Returns the
+        number of showings updated
+        '''
+        updated = 0
+        for pk, start_time, timezone_name, hours, closes_at in self.values_list(
+                'pk', 'start_time', 'timezone',
+                'activity__latest_reservation_time', 'booking_closes_at'):
+            new_closes_at = get_booking_closes_at(start_time, timezone_name,
+                hours)
+            if new_closes_at != closes_at:
+                updated += Showing.objects.filter(pk=pk).update(
+                    booking_closes_at=new_closes_at)
+        return updated
+
+    def with_occupancy(self):
+        '''
+        Annotate the showings with their number of reservations
+        (n_reservations), of reserved spaces (reserved_spaces) and their
+        occupancy in percent (occupancy), in the same query
+        '''
+        return self.annotate(
+            n_reservations=Count('reservation'),
+            reserved_spaces=Coalesce(Sum('reservation__n_spaces'), Value(0)),
+        ).annotate(
+            occupancy=Case(
+                When(total_spaces__gt=0, then=Cast(
+                    F('reserved_spaces'), FloatField()) * 100 / F('total_spaces')),
+                default=Value(0),
+                output_field=FloatField(),
+            ),
         )
 
-        translation.deactivate()
+    def reconcile_free_spaces(self):
+        '''
+        Recompute free_spaces from the reservations for all the showings in
+        the queryset in a single UPDATE, returns the number of showings
+        updated
+        '''
+        reserved = Reservation.objects.filter(
+            showing=OuterRef('pk')
+        ).order_by().values('showing').annotate(
+            total=Sum('n_spaces')
+        ).values('total')
+
+        activity_pks = set(self.values_list('activity_id', flat=True))
+
+        with transaction.atomic():
+            for activity_pk in activity_pks:
+                transaction.on_commit(
+                    lambda pk=activity_pk: bump_showing_list_version(pk))
+
+            if connection.vendor == 'postgresql':
+                # Wait for in-flight reservations and block new ones until
+                # the update is done, otherwise their seats could be missed
+                with connection.cursor() as cursor:
+                    cursor.execute('LOCK TABLE {} IN SHARE MODE'.format(
+                        connection.ops.quote_name(Reservation._meta.db_table)))
+
+            return self.update(free_spaces=F('total_spaces') - Coalesce(
+                Subquery(reserved, output_field=IntegerField()), Value(0)))
 
 
 class Showing(models.Model):
@@ -351,6 +763,21 @@ class Showing(models.Model):
         '(based on selected activity)', blank=True)
     free_spaces = models.IntegerField(help_text='Current number of available '
         'seats (based on current resevations)', blank=True)
+    booking_closes_at = models.DateTimeField(blank=True, null=True,
+        editable=False, help_text='When the bookings close (server time), '
+        'computed from the activity and the showing timezone')
+
+    objects = ShowingQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['activity', 'private', 'start_time'],
+                name='visits_showing_act_priv_start'),
+            models.Index(fields=['start_time'],
+                name='visits_showing_start_time'),
+            models.Index(fields=['activity', 'private', 'booking_closes_at'],
+                name='visits_showing_act_priv_close'),
+        ]
 
     def get_date_timezone(self, date):
         timezone_name = self.timezone if self.timezone else settings.TIME_ZONE
@@ -394,8 +821,12 @@ class Showing(models.Model):
         '''
         Return the activity in the current language
         '''
-        return Activity.objects.fallback(translation.get_language()).filter(
-            pk=self.activity.pk).get()
+        language = translation.get_language()
+        if self.activity.lang == language:
+            # No translation needed, e.g. with select_related('activity')
+            return self.activity
+        return Activity.objects.fallback(language).filter(
+            pk=self.activity_id).get()
 
     def save(self, **kwargs):
         if self.total_spaces is None:
@@ -407,37 +838,93 @@ class Showing(models.Model):
         if not self.end_time:
             self.end_time = self.start_time + self.activity.duration
 
-        super(Showing, self).save(**kwargs)
-        transaction.on_commit(self.update_spaces_count)
+        self.booking_closes_at = get_booking_closes_at(self.start_time,
+            self.timezone, self.activity.latest_reservation_time)
 
-    def update_spaces_count(self):
+        with transaction.atomic():
+            previous = None
+            if self.pk is not None:
+                previous = Showing.objects.select_for_update().filter(
+                    pk=self.pk).values('total_spaces', 'free_spaces').first()
+
+            if previous is not None:
+                # free_spaces is maintained by the reservations, so only
+                # apply the change in capacity to the current value instead
+                # of writing back what we have in memory
+                self.free_spaces = previous['free_spaces'] + \
+                    self.total_spaces - previous['total_spaces']
+
+            super(Showing, self).save(**kwargs)
+
+    def allocate_spaces(self, n_spaces):
         '''
-        Update the number of free_seats, called in Reservation.save()
+        Take n_spaces from the free spaces (a negative number gives them
+        back) with a single conditional UPDATE, so concurrent reservations
+        can't oversell the showing. Raises SpacesUnavailable if there are
+        not enough free spaces left
         '''
-        reserved_spaces = self.reservation_set.aggregate(
-            Sum('n_spaces')
-        )['n_spaces__sum'] or 0
-        free_spaces = self.total_spaces - reserved_spaces
+        if not n_spaces:
+            return
 
+        showings = Showing.objects.filter(pk=self.pk)
+        if n_spaces > 0:
+            showings = showings.filter(free_spaces__gte=n_spaces)
+
+        if not showings.update(free_spaces=F('free_spaces') - n_spaces):
+            if n_spaces < 0:
+                # The showing is gone, nothing to give back
+                return
+            free_spaces = Showing.objects.filter(pk=self.pk).values_list(
+                'free_spaces', flat=True).first()
+            raise SpacesUnavailable(free_spaces or 0)
+
+        if self.free_spaces is not None:
+            self.free_spaces -= n_spaces
+
+    def is_booking_closed(self):
+        return self.booking_closes_at is not None and \
+            self.booking_closes_at <= timezone.now()
+
+    def update_spaces_count(self):
+        '''
+        Recompute the number of free_seats from the reservations, only
+        needed to fix drift as free_spaces is kept up to date by
+        allocate_spaces()
+        '''
         # We use "update" so as not to trigger signals
-        Showing.objects.filter(pk=self.pk).update(free_spaces=free_spaces)
+        Showing.objects.filter(pk=self.pk).reconcile_free_spaces()
+
 
+def invalidate_showing_list(sender, instance, **kwargs):
+    '''
+    Bump the version of the cached showing lists of the activity once the
+    change is committed
+    '''
+    if isinstance(instance, Reservation):
+        activity_pk = instance.showing.activity_id
+    elif isinstance(instance, Showing):
+        activity_pk = instance.activity_id
+    else:
+        activity_pk = instance.source_id or instance.pk
+
+    transaction.on_commit(lambda: bump_showing_list_version(activity_pk))
 
-def generate_code(sender, instance, raw, **kwargs):
+
+def update_booking_closes_at(sender, instance, raw=False, **kwargs):
     '''
-    Done as signal in post_save as the PK used is assigned by the DB after
-    the save
+    Apply the reservation policy of the activity to its upcoming showings
     '''
     if raw:
         return
-
-    if instance.code == '':
-        # Generate code
-        hashids = Hashids(alphabet=settings.HASHIDS_ALPHABET,
-            salt=settings.HASHIDS_SALT, min_length=5)
-        instance.code = hashids.encrypt(instance.pk)
-        instance.save()
+    Showing.objects.filter(
+        activity=instance,
+        start_time__gte=timezone.now() - timedelta(days=1),
+    ).update_booking_closes_at()
 
 
-post_save.connect(generate_code, sender=Reservation)
 post_delete.connect(Reservation.delete_notification, sender=Reservation)
+post_save.connect(update_booking_closes_at, sender=Activity)
+
+for model in (Activity, ActivityProxy, Reservation, Showing):
+    post_save.connect(invalidate_showing_list, sender=model)
+    post_delete.connect(invalidate_showing_list, sender=model)
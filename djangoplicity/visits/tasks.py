@@ -2,14 +2,22 @@
 
 
 from __future__ import unicode_literals
-from datetime import datetime, date, timedelta
+from datetime import datetime, date, time, timedelta
+from multiprocessing.pool import ThreadPool
+from timeit import default_timer
 import pytz
 
 from django.conf import settings
+from django.core.mail import get_connection
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone, translation
 from celery.task import task
 from celery.utils.log import get_task_logger
 
-from djangoplicity.visits.models import Reservation
+from djangoplicity.visits.emails import EmailRenderer
+from djangoplicity.visits.models import OutboxEmail, Reservation, \
+    ReservationReminder, Showing
 
 
 logger = get_task_logger(__name__)
@@ -18,8 +26,12 @@ logger = get_task_logger(__name__)
 @task
 def reservation_reminder():
     """
-    Send a reminder for all visits happening the next day
-    Send a reminder for all visits the day after last modification
+    Send a reminder for the visits happening within the next days, in the
+    timezone of each showing
+    Send a reminder for the visits modified the day before
+
+    Reminders already sent are skipped, so this is meant to run frequently
+    (e.g. every 15 minutes) rather than once a day
     """
 
     # Only in prod
@@ -29,24 +41,317 @@ def reservation_reminder():
     if not getattr(settings, 'DP_VISITS_SEND_REMINDERS', True):
         return
 
-    reservations = []
+    send_reminders(iter_due_reminders())
+
+
+def get_showing_timezones(since):
+    """
+    Return a dict of the timezones of the showings starting after since,
+    to the values of Showing.timezone which use them
+    """
+    timezones = {}
+    for value in Showing.objects.filter(start_time__gte=since).order_by() \
+            .values_list('timezone', flat=True).distinct():
+        timezones.setdefault(value or settings.TIME_ZONE, []).append(value)
+    return timezones
+
+
+def iter_due_reminders():
+    """
+    Yield (reservation, kinds) for the reminders due now, with one query
+    per showing timezone
+    """
     # Set the filter date for sending reminders by default to 1 day (tomorrow)
     days_reminder = getattr(settings, 'SEND_RESERVATION_REMINDER_IN_DAYS', 1)
+    # Local hour of the showings from which their reminders are sent
+    reminder_hour = getattr(settings, 'VISITS_REMINDER_HOUR', 0)
 
-    if days_reminder >= 1:
-        # Get reservations that start within a specified day
-        day_to_start = date.today() + timedelta(days=days_reminder)
+    # last_modified is in the server timezone. Filter on datetime ranges
+    # rather than __date so the start_time and last_modified indexes can be
+    # used
+    today = datetime.combine(date.today(), time.min)
+    modified_range = (today - timedelta(days=1), today)
+
+    # Showings start times are in their own timezone, no timezone is more
+    # than a day away from the server one
+    timezones = get_showing_timezones(today - timedelta(days=1))
+
+    for timezone_name, values in timezones.items():
+        local_now = datetime.now(pytz.timezone(timezone_name)).replace(
+            tzinfo=None)
+        local_today = datetime.combine(local_now.date(), time.min)
+
+        # Showings from now until the end of the reminder day
+        upcoming_range = None
+        if days_reminder >= 1 and local_now.hour >= reminder_hour:
+            upcoming_range = (local_now,
+                local_today + timedelta(days=days_reminder + 1))
+
+        in_timezone = Q(showing__timezone__in=[v for v in values if v])
+        if settings.TIME_ZONE == timezone_name:
+            in_timezone |= Q(showing__timezone__isnull=True) | \
+                Q(showing__timezone='')
+
+        # A single query for both kinds, without the reservations already
+        # reminded so that a re-run doesn't send anything twice. Ordered by
+        # language so the batches are rendered with as few language
+        # switches as possible
         reservations = Reservation.objects.filter(
-            showing__start_time__date=day_to_start
-        )
-
-    # Get the reservations that were modified yesterday
-    yesterday = date.today() - timedelta(days=1)
-    reservations_yesterday = Reservation.objects.filter(
-        last_modified__date=yesterday
-    )
-
-    for reservation in reservations:
-        reservation.send_reminder_email()
-    for reservation in reservations_yesterday:
-        reservation.send_reminder_email()
+            in_timezone,
+            showing__start_time__gt=local_now,
+        ).pending_reminders(
+            upcoming_range, modified_range
+        ).for_email().order_by('language', 'pk')
+
+        for reservation in reservations.iterator():
+            kinds = []
+            if upcoming_range and not reservation.reminded_upcoming and \
+                    reservation.showing.start_time < upcoming_range[1]:
+                kinds.append(ReservationReminder.UPCOMING)
+            if not reservation.reminded_modified and \
+                    modified_range[0] <= reservation.last_modified < modified_range[1]:
+                kinds.append(ReservationReminder.MODIFIED)
+            yield reservation, kinds
+
+
+def batches(iterable, size):
+    """
+    Split iterable in lists of at most size items
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def send_reminders(reminders):
+    """
+    Send the reminders given as (reservation, kinds) in batches of
+    VISITS_REMINDER_BATCH_SIZE. The emails are rendered in this thread and
+    sent in parallel by VISITS_REMINDER_WORKERS threads, each one with its
+    own SMTP connection kept open for the whole run. Once sent the
+    reminders are recorded, so they are not sent again
+    """
+    batch_size = getattr(settings, 'VISITS_REMINDER_BATCH_SIZE', 100)
+    n_workers = max(getattr(settings, 'VISITS_REMINDER_WORKERS', 1), 1)
+    renderer = EmailRenderer('reminder')
+    sent = 0
+
+    # Open the connections ourselves so that send_messages() doesn't close
+    # them after each batch
+    connections = [get_connection() for i in range(n_workers)]
+    for connection in connections:
+        connection.open()
+    pool = ThreadPool(n_workers) if n_workers > 1 else None
+
+    try:
+        for n, batch in enumerate(batches(reminders, batch_size), 1):
+            start = default_timer()
+            kinds = {reservation.pk: k for reservation, k in batch}
+            rendered = list(renderer.render(
+                reservation for reservation, dummy_kinds in batch))
+            rendering_time = default_timer() - start
+
+            chunks = [rendered[i::n_workers] for i in range(n_workers)]
+            chunks = [chunk for chunk in chunks if chunk]
+            jobs = [
+                (connection, [message for dummy_reservation, message in chunk])
+                for connection, chunk in zip(connections, chunks)
+            ]
+            if pool is None:
+                results = [send_reminder_chunk(job) for job in jobs]
+            else:
+                results = pool.map(send_reminder_chunk, jobs)
+
+            # Record the reminders which were sent, even if the chunk or
+            # another one failed part way
+            error = None
+            markers = []
+            for chunk, (n_sent, chunk_error) in zip(chunks, results):
+                if chunk_error is not None:
+                    error = chunk_error
+                sent += n_sent
+                markers.extend(
+                    ReservationReminder(reservation=reservation, kind=kind)
+                    for reservation, dummy_message in chunk[:n_sent]
+                    for kind in kinds[reservation.pk]
+                )
+            ReservationReminder.objects.bulk_create(markers)
+
+            logger.info('Reminder batch %d: %d email(s) rendered in %.2fs, '
+                'sent in %.2fs', n, len(rendered), rendering_time,
+                default_timer() - start - rendering_time)
+
+            if error is not None:
+                raise error
+    finally:
+        if pool is not None:
+            pool.close()
+        for connection in connections:
+            connection.close()
+
+    logger.info('Sent %d reminder(s)', sent)
+    return sent
+
+
+def send_reminder_chunk(job):
+    """
+    Send a list of messages over the given connection, one at a time, return
+    the number of messages sent and the error which stopped the chunk, if
+    any. The messages before the error were delivered
+    """
+    connection, messages = job
+    n_sent = 0
+    for message in messages:
+        try:
+            connection.send_messages([message])
+        except Exception as e:  # pylint: disable=broad-except
+            return n_sent, e
+        n_sent += 1
+    return n_sent, None
+
+
+def queue_reservation_email(reservation, kind):
+    """
+    Add the email of the given kind for a reservation to the outbox, in the
+    current transaction, and have the outbox sent once it is committed
+    """
+    OutboxEmail.queue(reservation, kind)
+    transaction.on_commit(kick_outbox)
+
+
+def kick_outbox():
+    """
+    Have the outbox sent now. Best effort: the reservation is already
+    committed and the periodic send_outbox picks up the email anyway, so
+    e.g. an unreachable broker must not fail the request
+    """
+    try:
+        send_outbox.delay()
+    except Exception:  # pylint: disable=broad-except
+        logger.exception('Could not queue the sending of the outbox')
+
+
+@task
+def send_outbox():
+    """
+    Send the pending emails of the outbox in batches of
+    VISITS_OUTBOX_BATCH_SIZE over VISITS_OUTBOX_CONNECTIONS parallel SMTP
+    connections. Failed emails are retried later with an exponential
+    backoff, so this task should also run periodically, see
+    CELERY_BEAT_SCHEDULE in the test project settings
+    """
+    batch_size = getattr(settings, 'VISITS_OUTBOX_BATCH_SIZE', 100)
+    n_connections = getattr(settings, 'VISITS_OUTBOX_CONNECTIONS', 4)
+
+    while send_outbox_batch(batch_size, n_connections):
+        pass
+
+    backlog = OutboxEmail.objects.backlog()
+    logger.info('Outbox backlog: %d pending (oldest %s), %d failed',
+        backlog['pending'], backlog['oldest'], backlog['failed'])
+
+
+def send_outbox_batch(batch_size, n_connections):
+    """
+    Send one batch of due outbox emails, return the number of emails
+    processed. The rows are claimed in a short transaction with SKIP LOCKED,
+    by pushing their next attempt VISITS_OUTBOX_LEASE seconds ahead, so that
+    several workers can drain the outbox at the same time without holding
+    locks while talking to the SMTP server. Emails of a worker which died
+    are picked up again once the lease has expired
+    """
+    lease = getattr(settings, 'VISITS_OUTBOX_LEASE', 600)
+
+    with transaction.atomic():
+        # Only lock the outbox rows, FOR UPDATE can't be used with the
+        # outer joins of select_related()
+        pks = list(OutboxEmail.objects.due().select_for_update(
+            skip_locked=True).order_by('next_attempt').values_list(
+            'pk', flat=True)[:batch_size])
+        if not pks:
+            return 0
+        OutboxEmail.objects.filter(pk__in=pks).update(
+            next_attempt=timezone.now() + timedelta(seconds=lease))
+
+    emails = OutboxEmail.objects.filter(pk__in=pks).select_related(
+        'reservation__showing__activity', 'reservation__language')
+
+    # Render in this thread, only the SMTP part is done in parallel
+    renderers = {}
+    messages = []
+    for email in emails:
+        reservation = email.get_reservation()
+        if reservation is None:
+            email.record_failure('The reservation no longer exists',
+                retry=False)
+            continue
+        try:
+            if email.kind not in renderers:
+                renderers[email.kind] = EmailRenderer(email.kind)
+            with translation.override(reservation.language_id):
+                message = renderers[email.kind].build_email(reservation)
+        except Exception as e:  # pylint: disable=broad-except
+            logger.exception('Could not render outbox email %s', email.pk)
+            email.record_failure(e)
+            continue
+        messages.append((email, message))
+
+    chunks = [messages[i::n_connections] for i in range(n_connections)]
+    chunks = [chunk for chunk in chunks if chunk]
+    pool = ThreadPool(len(chunks) or 1)
+    try:
+        results = pool.map(send_messages,
+            [[message for dummy_email, message in chunk] for chunk in chunks])
+    finally:
+        pool.close()
+
+    sent = []
+    for chunk, errors in zip(chunks, results):
+        for (email, dummy_message), error in zip(chunk, errors):
+            if error is None:
+                sent.append(email.pk)
+            else:
+                logger.warning('Could not send outbox email %s: %s',
+                    email.pk, error)
+                email.record_failure(error)
+
+    OutboxEmail.objects.filter(pk__in=sent).update(
+        status=OutboxEmail.SENT, sent=timezone.now(),
+        attempts=F('attempts') + 1, last_error='')
+
+    return len(pks)
+
+
+def send_messages(messages):
+    """
+    Send the messages over a single SMTP connection, return for each one
+    the error that occurred or None. Any error is caught, so that a single
+    bad message (e.g. an invalid header) is retried or given up on its own
+    """
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception as e:  # pylint: disable=broad-except
+        return [e] * len(messages)
+
+    errors = []
+    try:
+        for message in messages:
+            try:
+                connection.send_messages([message])
+            except Exception as e:  # pylint: disable=broad-except
+                errors.append(e)
+            else:
+                errors.append(None)
+    finally:
+        try:
+            connection.close()
+        except Exception:  # pylint: disable=broad-except
+            pass
+
+    return errors
@@ -36,7 +36,8 @@ from django.contrib.auth.decorators import login_required
 from djangoplicity.visits.views import (
     ReservationCreateView, ReservationDeleteView, ReservationConfirmView,
     ReservationDeleteConfirmView, ReservationUpdateView, ShowingListView,
-    ShowingReportDetailView, ShowingReportListView, ReservationCancelView
+    ShowingReportDetailView, ShowingReportListView, ReservationCancelView,
+    ShowingAvailabilityView, ShowingManifestExportView
 )
 
 urlpatterns = [
@@ -45,6 +46,9 @@ urlpatterns = [
     url(r'^reports/(?P<pk>[-\w]+)/$', login_required(
         ShowingReportDetailView.as_view()),
         name='visits-showings-reports-detail'),
+    url(r'^reports/(?P<pk>[-\w]+)/manifest\.(?P<export_format>csv|xlsx)$',
+        login_required(ShowingManifestExportView.as_view()),
+        name='visits-showings-reports-manifest'),
     url(r'^delete/(?P<code>[-\w]+)/$', ReservationDeleteView.as_view(),
         name='visits-reservation-delete'),
     url(r'^confirmed/(?P<code>[-\w]+)/$', ReservationConfirmView.as_view(),
@@ -57,6 +61,8 @@ urlpatterns = [
         name='visits-reservation-cancel'),
     url(r'^booking/(?P<showingpk>[-\w]+)/$', ReservationCreateView.as_view(),
         name='visits-reservation-create'),
+    url(r'^(?P<pk>[-\w]+)/availability/$', ShowingAvailabilityView.as_view(),
+        name='visits-showings-availability'),
     url(r'^(?P<pk>[-\w]+)/$', ShowingListView.as_view(),
         name='visits-showings-list'),
 ]
@@ -29,19 +29,34 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE
 
-from datetime import datetime, time, timedelta
-import pytz
+import copy
+from datetime import timedelta
+import hashlib
+import json
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.urlresolvers import reverse
-from django.http import Http404, HttpResponseRedirect
+from django.db import transaction
+from django.db.models import Prefetch
+from django.http import Http404, HttpResponse, HttpResponseRedirect
 from django.utils import timezone, translation
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.encoding import force_bytes
+from django.utils.translation import gettext_lazy as _
 from django.views.generic import (
     CreateView, DeleteView, DetailView, ListView, TemplateView, UpdateView
 )
 
-from djangoplicity.visits.forms import ReservationForm
-from djangoplicity.visits.models import Activity, Reservation, Showing
+from djangoplicity.visits.caching import get_showing_list_key, \
+    get_showing_list_timeout
+from djangoplicity.visits.exports import MANIFEST_COLUMNS, \
+    export_response, iter_manifest_rows
+from djangoplicity.visits.forms import ReservationForm, \
+    ShowingReportFilterForm
+from djangoplicity.visits.models import Activity, Reservation, Showing, \
+    SpacesUnavailable
+from djangoplicity.visits.tasks import queue_reservation_email
 
 from djangoplicity.translation.models import translation_reverse
 
@@ -57,32 +72,7 @@ class ReservationCreateView(CreateView):
         context['activity'] = showing.get_activity()
         context['other_showings'] = self.get_other_showings()
 
-        berlintz = pytz.timezone('Europe/Berlin')
-        santiagotz = pytz.timezone('America/Santiago')
-        berlinnow = berlintz.localize(datetime.now())
-        santiagonow = berlinnow.astimezone(santiagotz)
-        #  dt = santiagotz.localize(showing.start_time) - santiagonow
-        #  context['time_remaining'] = dt.days * 24 + dt.seconds / 3600.
-
-        #  context['too_late'] = showing.start_time - timedelta(
-        #      hours=showing.activity.latest_reservation_time) < timezone.now()
-
-        # <latest_reservation_time> before start
-        #  context['too_late'] = dt < timedelta(
-        #      hours=showing.activity.latest_reservation_time)
-
-        # Friday noon
-        #  print 'DEBUG'
-        #  print santiagonow.date()
-        #  print santiagotz.localize(showing.start_time).date()
-        #  print santiagotz.localize(showing.start_time).date() - timedelta(days=1)
-        #  print santiagonow.time()
-        #  print 'DEBUG'
-
-        context['too_late'] = (
-            santiagonow.date() >= santiagotz.localize(showing.start_time).date() - timedelta(days=1)
-            and santiagonow.time() > time(hour=13)
-        )
+        context['too_late'] = showing.is_booking_closed()
 
         return context
 
@@ -117,20 +107,31 @@ class ReservationCreateView(CreateView):
         return initial
 
     def get_other_showings(self):
-        showing = self.get_showing()
-        return showing.activity.showings.filter(
-            private=False,
-            start_time__gt=timezone.now(),
-        ).order_by('start_time')
+        # Prefetched by get_showing()
+        return self.get_showing().activity.upcoming_showings
 
     def get_showing(self):
         if hasattr(self, 'showing'):
             return self.showing  # pylint: disable=access-member-before-definition
 
         now = timezone.now()
-        k = self.kwargs['showingpk']
         try:
-            self.showing = Showing.objects.get(
+            # The showing with its activity, then its languages (for the
+            # form) and the other upcoming showings of the activity, in
+            # three queries
+            self.showing = Showing.objects.select_related(
+                'activity', 'activity__key_visual_en',
+            ).prefetch_related(
+                'offered_languages',
+                Prefetch(
+                    'activity__showings',
+                    queryset=Showing.objects.bookable().filter(
+                        private=False,
+                        start_time__gt=now,
+                    ).order_by('start_time'),
+                    to_attr='upcoming_showings',
+                ),
+            ).get(
                 pk=self.kwargs['showingpk'],
                 start_time__gt=now,
             )
@@ -142,7 +143,6 @@ class ReservationCreateView(CreateView):
         return self.showing
 
     def get_success_url(self, **kwargs):
-        self.object.send_confirmation_email()
         # return reverse('visits-reservation-confirm', args=[self.object.code])
         return translation_reverse(
             'visits-reservation-confirm',
@@ -150,11 +150,22 @@ class ReservationCreateView(CreateView):
             lang=self.object.language.code)
 
     def form_valid(self, form):
-        reservation = form.save(commit=False)
-        reservation.save()
+        if self.get_showing().is_booking_closed():
+            form.add_error(None, _('Reservations for this showing are closed'))
+            return self.form_invalid(form)
+
+        # Save only once, CreateView.form_valid() would save the form again
+        try:
+            # The email is added to the outbox in the same transaction
+            with transaction.atomic():
+                self.object = form.save()
+                queue_reservation_email(self.object, 'confirmation')
+        except SpacesUnavailable as e:
+            form.add_spaces_unavailable_error(e.free_spaces)
+            return self.form_invalid(form)
         if form.cleaned_data.get('subscribe_checkbox', False):
             self.subscribe_contact(form.cleaned_data)
-        return super(ReservationCreateView, self).form_valid(form)
+        return HttpResponseRedirect(self.get_success_url())
 
 
 class ReservationDeleteView(DeleteView):
@@ -164,8 +175,20 @@ class ReservationDeleteView(DeleteView):
     slug_field = 'code'
     #  success_url = '/public/weekend-visits/reservation-cancelled/'
 
+    def delete(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        success_url = self.get_success_url()
+        with transaction.atomic():
+            # Lock the reservation, so that if the form is submitted twice
+            # the second request waits for the first one and finds it gone
+            if not Reservation.objects.select_for_update().filter(
+                    pk=self.object.pk).exists():
+                return HttpResponseRedirect(success_url)
+            queue_reservation_email(self.object, 'deleted')
+            self.object.delete()
+        return HttpResponseRedirect(success_url)
+
     def get_success_url(self, **kwargs):
-        self.object.send_deleted_email()
         #  return reverse('visits-reservation-delete-confirm')
         return translation_reverse(
             'visits-reservation-delete-confirm',
@@ -191,18 +214,49 @@ class ReservationUpdateView(UpdateView):
     slug_field = 'code'
     template_name = 'visits/reservation_update.html'
 
+    def get_queryset(self):
+        # Everything needed by the form and the page along with the
+        # reservation
+        return super(ReservationUpdateView, self).get_queryset().select_related(
+            'showing__activity', 'language',
+        ).prefetch_related('showing__offered_languages')
+
+    def get_object(self, queryset=None):
+        # Only look up the reservation once per request
+        if queryset is not None:
+            return super(ReservationUpdateView, self).get_object(queryset)
+        if not hasattr(self, '_reservation'):
+            self._reservation = super(ReservationUpdateView, self).get_object()
+            # The form changes the reservation in place, the page is about
+            # the reservation as stored
+            self._stored_reservation = copy.copy(self._reservation)
+        return self._reservation
+
     def get_context_data(self, **kwargs):
         context = super(ReservationUpdateView, self).get_context_data(**kwargs)
-        reservation = self.get_object()
-        showing = reservation.showing
-        other_reservations = showing.reservation_set.filter(email=reservation.email).exclude(code=reservation.code)
+        self.get_object()
+        reservation = self._stored_reservation
+        # Served by the (showing, email) index
+        other_reservations = Reservation.objects.filter(
+            showing_id=reservation.showing_id,
+            email=reservation.email,
+        ).exclude(pk=reservation.pk)
         context['other_reservations'] = other_reservations
-        context['activity'] = self.get_object().showing.get_activity()
+        context['activity'] = reservation.showing.get_activity()
 
         return context
 
+    def form_valid(self, form):
+        try:
+            with transaction.atomic():
+                response = super(ReservationUpdateView, self).form_valid(form)
+                queue_reservation_email(self.object, 'updated')
+            return response
+        except SpacesUnavailable as e:
+            form.add_spaces_unavailable_error(e.free_spaces)
+            return self.form_invalid(form)
+
     def get_success_url(self, **kwargs):
-        self.object.send_updated_email()
         #  return reverse('visits-reservation-confirm', args=[self.object.code])
         return translation_reverse(
             'visits-reservation-confirm',
@@ -220,6 +274,8 @@ class ReservationCancelView(ReservationUpdateView):
 
 class ShowingListView(ListView):
     model = Showing
+    context_object_name = 'showing_list'
+    template_name = 'visits/showing_list.html'
 
     def get_activity(self, pk):
         try:
@@ -238,37 +294,182 @@ class ShowingListView(ListView):
         context['activity']  = self.activity
         return context
 
+    def get_cached_showings(self, pk):
+        '''
+        Return the activity and its upcoming showings from the cache, the
+        cache is invalidated whenever a showing or reservation changes
+        '''
+        key = get_showing_list_key(pk, translation.get_language())
+        data = cache.get(key)
+
+        if data is None:
+            activity = self.get_activity(pk)
+            if not activity:
+                return None, []
+
+            # Load the poster now so it is cached with the activity
+            activity.key_visual_en  # pylint: disable=pointless-statement
+            data = (activity, list(self.get_upcoming_showings(activity)))
+            cache.set(key, data, get_showing_list_timeout())
+
+        return data
 
     def get(self, request, *args, **kwargs):
         pk = self.kwargs.pop('pk')
-        activity = self.get_activity(pk)
+        self.activity, self.showings = self.get_cached_showings(pk)
 
-        if not activity:
+        if not self.activity:
             return HttpResponseRedirect(reverse('visits-reservation-create',
                 args=[pk]))
 
         return super(ShowingListView, self).get(request, *args, **kwargs)
 
-    def get_queryset(self):
+    def get_upcoming_showings(self, activity):
         now = timezone.now()
-        qs = self.activity.showings.filter(
+        qs = activity.showings.bookable().filter(
             private=False,
             start_time__gt=now
         )
         return (qs.order_by('start_time'))
 
+    def get_queryset(self):
+        # Showings may have started or their bookings closed since the list
+        # was cached
+        now = timezone.now()
+        return [showing for showing in self.showings
+            if showing.start_time > now and not showing.is_booking_closed()]
+
+
+class ShowingAvailabilityView(ShowingListView):
+    '''
+    Compact JSON version of the showing list for polling clients. It sends
+    a strong ETag so unchanged availability only costs a 304
+    '''
+
+    def get(self, request, *args, **kwargs):
+        self.activity, self.showings = self.get_cached_showings(
+            self.kwargs['pk'])
+
+        if not self.activity:
+            raise Http404
+
+        content = force_bytes(json.dumps([
+            {
+                'id': showing.pk,
+                'start': showing.start_time.isoformat(),
+                'free_spaces': max(showing.free_spaces, 0),
+                'fully_booked': showing.free_spaces <= 0,
+            }
+            for showing in self.get_queryset()
+        ], separators=(',', ':')))
+
+        response = HttpResponse(content, content_type='application/json')
+        response['ETag'] = '"{}"'.format(hashlib.sha1(content).hexdigest())
+        patch_cache_control(response, public=True,
+            max_age=getattr(settings, 'VISITS_AVAILABILITY_MAX_AGE', 5))
+
+        return get_conditional_response(request, etag=response['ETag'],
+            response=response)
+
 
 class ShowingReportDetailView(DetailView):
     model = Showing
     template_name = 'visits/showing_report_detail.html'
 
+    def get_queryset(self):
+        return super(ShowingReportDetailView, self).get_queryset() \
+            .select_related('activity')
+
+    def get_reservations(self):
+        return self.object.reservation_set.select_related('language') \
+            .order_by('created', 'pk')
+
+    def get_context_data(self, **kwargs):
+        context = super(ShowingReportDetailView, self).get_context_data(**kwargs)
+        context['reservation_list'] = self.get_reservations()
+        return context
+
+
+class ShowingManifestExportView(ShowingReportDetailView):
+    '''
+    Stream the manifest of a showing as CSV or XLSX
+    '''
+    def get(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        return export_response(
+            self.kwargs['export_format'],
+            MANIFEST_COLUMNS,
+            iter_manifest_rows(self.object.reservation_set.all()),
+            'Manifest-{}-{}'.format(self.object.activity_id,
+                self.object.start_time.strftime('%Y-%m-%d-%H%M')),
+        )
+
 
 class ShowingReportListView(ListView):
     model = Showing
     template_name = 'visits/showing_report_list.html'
+    paginate_by = 50
+
+    # Maximum number of reservations listed for a search
+    search_limit = 50
+
+    def get_filter_form(self):
+        if not hasattr(self, 'filter_form'):
+            self.filter_form = ShowingReportFilterForm(self.request.GET)
+            self.filter_form.is_valid()
+        return self.filter_form
+
+    def get_filters(self):
+        '''
+        Return the valid filters of the request
+        '''
+        return self.get_filter_form().cleaned_data
+
+    def get_search_query(self):
+        return (self.get_filters().get('q') or '').strip()
 
     def get_queryset(self):
-        return (
+        queryset = (
             super(ShowingReportListView, self).get_queryset()
-            .order_by('activity__name', 'start_time')
+            .select_related('activity')
+            .with_occupancy()
+            .order_by('activity__name', 'start_time', 'pk')
         )
+
+        filters = self.get_filters()
+        now = timezone.now()
+        if filters.get('activity'):
+            queryset = queryset.filter(activity=filters['activity'])
+        if filters.get('start_date'):
+            queryset = queryset.filter(start_time__gte=filters['start_date'])
+        if filters.get('end_date'):
+            queryset = queryset.filter(
+                start_time__lt=filters['end_date'] + timedelta(days=1))
+        if filters.get('when') == ShowingReportFilterForm.UPCOMING:
+            queryset = queryset.filter(start_time__gte=now)
+        elif filters.get('when') == ShowingReportFilterForm.PAST:
+            queryset = queryset.filter(start_time__lt=now)
+
+        query = self.get_search_query()
+        if query:
+            # Only the showings with reservations matching the search
+            queryset = queryset.filter(pk__in=Reservation.objects.search(
+                query).values('showing'))
+        return queryset
+
+    def get_context_data(self, **kwargs):
+        context = super(ShowingReportListView, self).get_context_data(**kwargs)
+        query = self.get_search_query()
+        context['q'] = query
+        context['filter_form'] = self.get_filter_form()
+
+        # The filters, to keep them in the pagination links
+        params = self.request.GET.copy()
+        params.pop(self.page_kwarg, None)
+        context['filter_query'] = params.urlencode()
+
+        if query:
+            context['reservation_list'] = Reservation.objects.search(
+                query).select_related('showing__activity').order_by(
+                'showing__start_time', 'pk')[:self.search_limit]
+        return context
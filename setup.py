@@ -48,6 +48,7 @@ setup(
         'xlrd',
         'xlwt',
         'django-import-export==1.2.0',
+        'openpyxl',
     ],
 
     # metadata for upload to PyPI
@@ -364,3 +364,20 @@ EMAIL_HOST = 'smtp.mailtrap.io'
 EMAIL_HOST_USER = '9bf800ee730746'
 EMAIL_HOST_PASSWORD = 'f3162e99c9f248'
 EMAIL_PORT = '2525'
+
+# Celery, tasks are run synchronously in the test project
+CELERY_TASK_ALWAYS_EAGER = True
+CELERY_TASK_EAGER_PROPAGATES = True
+
+# Periodic tasks, run by celery beat. The outbox is also sent right after
+# each reservation change, the periodic run retries the failed emails
+CELERY_BEAT_SCHEDULE = {
+    'visits-send-outbox': {
+        'task': 'djangoplicity.visits.tasks.send_outbox',
+        'schedule': 300,
+    },
+    'visits-reservation-reminder': {
+        'task': 'djangoplicity.visits.tasks.reservation_reminder',
+        'schedule': 900,
+    },
+}
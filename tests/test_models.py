@@ -1,9 +1,25 @@
 # coding=utf-8
-from django.test import TestCase, Client, TransactionTestCase
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+from unittest import skipUnless
+from django.db import connection
+from django.db.models import Sum
+from django.test import TestCase, Client, TransactionTestCase, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth import get_user_model
 from django.core import mail
+from django.core.management import call_command
+from django.forms.models import model_to_dict
+from django.utils.six import StringIO
 from django.utils.translation import gettext_lazy as _
-from djangoplicity.visits.models import Language, Reservation, Showing
+from mock import patch
+from tablib import Dataset
+from djangoplicity.visits.admin import ReservationResource
+from djangoplicity.visits.forms import ReservationAdminForm
+from djangoplicity.visits.emails import EmailRenderer, get_activity_context, \
+    html_to_text
+from djangoplicity.visits.models import Language, Reservation, Showing, SpacesUnavailable, \
+    generate_code, next_reservation_ids
 from .factories import factory_activity, factory_showing, factory_reservation
 
 
@@ -73,6 +89,45 @@ class ShowingTestCase(TransactionTestCase):
         self.assertEqual(showing.total_spaces, self.activity.max_participants)
         self.assertEqual(showing.end_time, showing.start_time + self.activity.duration)
 
+    def test_booking_closes_at(self):
+        showing = factory_showing(self.activity, {
+            'start_time': datetime(2030, 3, 9, 10, 0),
+            'timezone': 'America/Santiago',
+        })
+        showing.save()
+        # 24 hours before in Santiago (-03), 13:00 that day would be later
+        self.assertEqual(showing.booking_closes_at, datetime(2030, 3, 8, 13, 0))
+        self.assertFalse(showing.is_booking_closed())
+
+        showing.start_time = datetime(2030, 3, 9, 14, 0)
+        showing.save()
+        # The day before at 13:00
+        self.assertEqual(showing.booking_closes_at, datetime(2030, 3, 8, 16, 0))
+
+        # Never after latest_reservation_time hours before the start
+        self.activity.latest_reservation_time = 2
+        self.activity.save()
+        showing.refresh_from_db()
+        self.assertEqual(showing.booking_closes_at, datetime(2030, 3, 9, 15, 0))
+
+        with self.settings(VISITS_BOOKING_CUTOFF_TIME=None):
+            self.activity.latest_reservation_time = 48
+            self.activity.save()
+        showing.refresh_from_db()
+        self.assertEqual(showing.booking_closes_at, datetime(2030, 3, 7, 17, 0))
+
+        showing.start_time = datetime.now() + timedelta(hours=1)
+        showing.timezone = None
+        showing.save()
+        self.assertTrue(showing.is_booking_closed())
+        self.assertFalse(Showing.objects.bookable().filter(pk=showing.pk).exists())
+
+        # Without a value the bookings are open, as for bookable()
+        Showing.objects.filter(pk=showing.pk).update(booking_closes_at=None)
+        showing.refresh_from_db()
+        self.assertFalse(showing.is_booking_closed())
+        self.assertTrue(Showing.objects.bookable().filter(pk=showing.pk).exists())
+
     def test_update_spaces_count(self):
         activity = factory_activity({})
         showing = factory_showing(activity, {
@@ -89,6 +144,83 @@ class ShowingTestCase(TransactionTestCase):
         showing.refresh_from_db()
         self.assertEqual(showing.free_spaces, 5)
 
+    def test_total_spaces_change_keeps_reservations(self):
+        showing = factory_showing(self.activity, {
+            'total_spaces': 20,
+            'free_spaces': 20
+        })
+        showing.save()
+        factory_reservation(showing, {
+            'n_spaces': 5
+        }).save()
+
+        # The in-memory free_spaces is stale, it must not be written back
+        stale = Showing.objects.get(pk=showing.pk)
+        factory_reservation(showing, {
+            'n_spaces': 3
+        }).save()
+        stale.total_spaces = 30
+        stale.save()
+
+        showing.refresh_from_db()
+        self.assertEqual(showing.total_spaces, 30)
+        self.assertEqual(showing.free_spaces, 22)
+
+    def test_reconcile_free_spaces_command(self):
+        showing = factory_showing(self.activity, {
+            'total_spaces': 20,
+            'free_spaces': 20
+        })
+        showing.save()
+        factory_reservation(showing, {
+            'n_spaces': 4
+        }).save()
+        Showing.objects.filter(pk=showing.pk).update(free_spaces=7)
+
+        out = StringIO()
+        call_command('reconcile_free_spaces', '--dry-run', stdout=out)
+        showing.refresh_from_db()
+        self.assertEqual(showing.free_spaces, 7)
+        self.assertIn('Showing {}: 7 free spaces, expected 16'.format(showing.pk), out.getvalue())
+
+        call_command('reconcile_free_spaces', stdout=StringIO())
+        showing.refresh_from_db()
+        self.assertEqual(showing.free_spaces, 16)
+
+    @skipUnlessDBFeature('has_select_for_update')
+    def test_concurrent_reservations_do_not_oversell(self):
+        showing = factory_showing(self.activity, {
+            'total_spaces': 20,
+            'free_spaces': 20
+        })
+        showing.save()
+        language = Language.objects.get(code='en')
+
+        def book(i):
+            try:
+                reservation = factory_reservation(
+                    Showing.objects.get(pk=showing.pk), {
+                        'language': language,
+                        'n_spaces': 3
+                    })
+                reservation.save()
+                return True
+            except SpacesUnavailable:
+                return False
+            finally:
+                connection.close()
+
+        pool = ThreadPool(10)
+        results = pool.map(book, range(30))
+        pool.close()
+        pool.join()
+
+        showing.refresh_from_db()
+        reserved = showing.reservation_set.aggregate(Sum('n_spaces'))['n_spaces__sum']
+        self.assertEqual(results.count(True), 6)
+        self.assertEqual(reserved, 18)
+        self.assertEqual(showing.free_spaces, 2)
+
 
 class ReservationTestCase(TestCase):
     fixtures = ['visits']
@@ -97,7 +229,9 @@ class ReservationTestCase(TestCase):
 
     def setUp(self):
         self.activity = factory_activity({})
-        self.showing = factory_showing(self.activity, {})
+        self.showing = factory_showing(self.activity, {
+            'total_spaces': 20
+        })
         self.showing.save()
 
     def test_create_reservation(self):
@@ -114,6 +248,159 @@ class ReservationTestCase(TestCase):
         self.assertIn('11 spaces', unicode(reservation))
         self.assertIsInstance(reservation, Reservation)
 
+    def test_reservation_allocates_spaces(self):
+        reservation = factory_reservation(self.showing, {
+            'n_spaces': 4
+        })
+        reservation.save()
+        self.showing.refresh_from_db()
+        self.assertEqual(self.showing.free_spaces, 16)
+
+        reservation.n_spaces = 1
+        reservation.save()
+        self.showing.refresh_from_db()
+        self.assertEqual(self.showing.free_spaces, 19)
+
+        reservation.delete()
+        self.showing.refresh_from_db()
+        self.assertEqual(self.showing.free_spaces, 20)
+
+    def test_reservation_deleted_twice(self):
+        """Ensure the spaces are only given back by the delete which removed the row."""
+        reservation = factory_reservation(self.showing, {
+            'n_spaces': 4
+        })
+        reservation.save()
+        stale = Reservation.objects.get(pk=reservation.pk)
+
+        reservation.delete()
+        stale.delete()
+        self.showing.refresh_from_db()
+        self.assertEqual(self.showing.free_spaces, 20)
+
+    def test_admin_form_full_showing(self):
+        """Ensure the admin reports a full showing on n_spaces instead of failing."""
+        reservation = factory_reservation(self.showing, {
+            'n_spaces': 4
+        })
+        reservation.save()
+        factory_reservation(self.showing, {
+            'n_spaces': 16
+        }).save()
+
+        data = model_to_dict(reservation)
+        data['n_spaces'] = 5
+        form = ReservationAdminForm(data, instance=reservation)
+        self.assertFalse(form.is_valid())
+        self.assertIn('n_spaces', form.errors)
+        self.showing.refresh_from_db()
+        self.assertEqual(self.showing.free_spaces, 0)
+
+        data['n_spaces'] = 3
+        form = ReservationAdminForm(data, instance=reservation)
+        self.assertTrue(form.is_valid(), form.errors)
+        form.save()
+        self.showing.refresh_from_db()
+        self.assertEqual(self.showing.free_spaces, 1)
+
+    def test_reservation_rejected_when_full(self):
+        factory_reservation(self.showing, {
+            'n_spaces': 18
+        }).save()
+        reservation = factory_reservation(self.showing, {
+            'n_spaces': 3
+        })
+
+        with self.assertRaises(SpacesUnavailable) as cm:
+            reservation.save()
+
+        self.assertEqual(cm.exception.free_spaces, 2)
+        self.assertIsNone(reservation.pk)
+        self.showing.refresh_from_db()
+        self.assertEqual(self.showing.free_spaces, 2)
+
+    def get_import_dataset(self, n_spaces):
+        dataset = Dataset(headers=['showing', 'name', 'phone', 'email', 'country', 'language', 'n_spaces'])
+        for i in range(1, 4):
+            dataset.append([self.activity.name, 'Visitor {}'.format(i), '091 123 4356',
+                            'visitor{}@mail.com'.format(i), 'Chile', 'en', n_spaces])
+        return dataset
+
+    def test_import_reservations(self):
+        result = ReservationResource().import_data(self.get_import_dataset(5))
+
+        reservations = Reservation.objects.filter(showing=self.showing)
+        self.assertFalse(result.has_errors())
+        self.assertEqual(reservations.count(), 3)
+        self.assertEqual(len(set(reservations.values_list('code', flat=True))), 3)
+        self.assertNotIn('', reservations.values_list('code', flat=True))
+        self.showing.refresh_from_db()
+        self.assertEqual(self.showing.free_spaces, 5)
+
+    @skipUnless(connection.vendor == 'postgresql', 'New reservations are only imported in bulk on PostgreSQL')
+    def test_import_reservations_in_bulk(self):
+        factory_reservation(self.showing, {'n_spaces': 2}).save()
+
+        with CaptureQueriesContext(connection) as queries:
+            result = ReservationResource().import_data(self.get_import_dataset(5))
+        sqls = [q['sql'] for q in queries.captured_queries]
+
+        self.assertFalse(result.has_errors())
+        # The three reservations with their codes in a single INSERT by
+        # after_import(), without locking the reservations table
+        self.assertEqual(len([sql for sql in sqls if sql.startswith('INSERT INTO "visits_reservation"')]), 1)
+        self.assertFalse([sql for sql in sqls if sql.startswith('UPDATE "visits_reservation"')])
+        self.assertFalse([sql for sql in sqls if sql.startswith('LOCK TABLE')])
+        for pk, code in Reservation.objects.filter(email__startswith='visitor').values_list('pk', 'code'):
+            self.assertEqual(code, generate_code(pk))
+        self.showing.refresh_from_db()
+        self.assertEqual(self.showing.free_spaces, 3)
+
+    @skipUnless(connection.vendor == 'postgresql', 'New reservations are only imported in bulk on PostgreSQL')
+    def test_bulk_reserve_over_capacity(self):
+        reservations = [factory_reservation(self.showing, {'n_spaces': 7}) for i in range(3)]
+        for reservation, pk in zip(reservations, next_reservation_ids(3)):
+            reservation.pk = pk
+            reservation.code = generate_code(pk)
+
+        with self.assertRaises(SpacesUnavailable) as cm:
+            Reservation.objects.bulk_reserve(reservations)
+
+        self.assertEqual(cm.exception.free_spaces, 20)
+        self.assertFalse(Reservation.objects.filter(showing=self.showing).exists())
+        self.showing.refresh_from_db()
+        self.assertEqual(self.showing.free_spaces, 20)
+
+    def test_import_reservations_over_capacity(self):
+        result = ReservationResource().import_data(self.get_import_dataset(7))
+
+        self.assertTrue(result.has_errors())
+        self.assertFalse(Reservation.objects.filter(showing=self.showing).exists())
+        self.showing.refresh_from_db()
+        self.assertEqual(self.showing.free_spaces, 20)
+
+    def test_search_reservations(self):
+        reservation = factory_reservation(self.showing, {
+            'name': 'Jhon Doe',
+            'email': 'jdoe@mail.com',
+            'vehicle_plate': 'AB-1234',
+            'n_spaces': 1,
+        })
+        reservation.save()
+        factory_reservation(self.showing, {
+            'name': 'Larry Smith',
+            'email': 'lsmith@mail.com',
+            'vehicle_plate': '',
+            'n_spaces': 1,
+        }).save()
+
+        search = Reservation.objects.search
+        self.assertEqual(list(search('JDOE')), [reservation])
+        self.assertEqual(list(search('doe b-12')), [reservation])
+        self.assertEqual(list(search(reservation.code)), [reservation])
+        self.assertEqual(search('mail.com').count(), 2)
+        self.assertEqual(search('doe smith').count(), 0)
+
     def test_send_confirmation_email(self):
         reservation = factory_reservation(self.showing, {})
         reservation.save()
@@ -157,3 +444,50 @@ class ReservationTestCase(TestCase):
 
         # Verify that the subject of the first message is correct.
         self.assertEqual(mail.outbox[0].subject, _('Reservation updated'))
+
+    def test_email_renderer(self):
+        reservations = []
+        for code in ('es', 'en', 'es'):
+            reservation = factory_reservation(self.showing, {
+                'n_spaces': 1,
+                'language': Language.objects.get(code=code),
+            })
+            reservation.save()
+            reservations.append(reservation)
+
+        renderer = EmailRenderer('reminder')
+        with patch('djangoplicity.visits.emails.get_activity_context',
+                wraps=get_activity_context) as mock_get_activity_context:
+            rendered = list(renderer.render(reservations))
+
+        # Grouped by language, the activity context is computed once per language
+        self.assertEqual(
+            [reservation for reservation, message in rendered],
+            [reservations[0], reservations[2], reservations[1]])
+        self.assertEqual(mock_get_activity_context.call_count, 2)
+        self.assertEqual(
+            [message.to for reservation, message in rendered],
+            [[reservation.email] for reservation, message in rendered])
+
+    def test_email_text_template(self):
+        reservation = factory_reservation(self.showing, {})
+        reservation.save()
+
+        message = reservation.build_email('confirmation')
+        self.assertIn(reservation.code, message.body)
+        self.assertNotIn('<li>', message.body)
+
+        # Without the text templates the HTML is converted
+        with self.settings(VISITS_EMAIL_TEXT_TEMPLATES=False):
+            with patch('djangoplicity.visits.emails.html_to_text',
+                    return_value='converted') as mock_html_to_text:
+                message = reservation.build_email('confirmation')
+        self.assertEqual(message.body, 'converted')
+        self.assertEqual(mock_html_to_text.call_count, 1)
+
+    def test_html_to_text_cache(self):
+        with patch('djangoplicity.visits.emails.html2text.html2text',
+                return_value='text') as mock_html2text:
+            for i in range(3):
+                self.assertEqual(html_to_text('<p>cached {}</p>'.format(self.id())), 'text')
+        self.assertEqual(mock_html2text.call_count, 1)
@@ -0,0 +1,130 @@
+from datetime import datetime, timedelta
+from unittest import skipUnless
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from djangoplicity.visits.models import Language, Reservation, Showing
+from djangoplicity.visits.paginators import EstimatedCountPaginator
+from .factories import factory_activity, fake
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Query plans are only checked on PostgreSQL')
+class TestQueryPlans(TestCase):
+    """
+    Make sure the hot visits queries keep using indexes on a large
+    synthetic dataset
+    """
+    fixtures = ['visits']
+    n_activities = 20
+    showings_per_activity = 250
+    reservations_per_showing = 8
+
+    def setUp(self):
+        now = datetime.now()
+        language = Language.objects.get(code='en')
+
+        showings = []
+        for i in range(self.n_activities):
+            activity = factory_activity({})
+            for j in range(self.showings_per_activity):
+                start_time = now + timedelta(days=j - self.showings_per_activity // 2, hours=i % 12)
+                showings.append(Showing(
+                    activity=activity,
+                    start_time=start_time,
+                    end_time=start_time + timedelta(hours=2),
+                    private=j % 5 == 0,
+                    total_spaces=50,
+                    free_spaces=50,
+                ))
+        Showing.objects.bulk_create(showings)
+
+        reservations = []
+        for n, showing_id in enumerate(Showing.objects.values_list('pk', flat=True)):
+            for k in range(self.reservations_per_showing):
+                i = n * self.reservations_per_showing + k
+                reservations.append(Reservation(
+                    code='c{}'.format(i),
+                    showing_id=showing_id,
+                    name=fake.name(),
+                    phone='091 123 4356',
+                    email='visitor{}@mail.com'.format(i),
+                    country='Chile',
+                    language=language,
+                    n_spaces=2,
+                    last_modified=now - timedelta(minutes=i),
+                ))
+        Reservation.objects.bulk_create(reservations, batch_size=2000)
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE visits_showing')
+            cursor.execute('ANALYZE visits_reservation')
+
+        self.showing = Showing.objects.filter(private=False).order_by('pk')[100]
+        self.now = now
+
+    def get_plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN ' + sql, params)
+            return '\n'.join(row[0] for row in cursor.fetchall())
+
+    def assertUsesIndex(self, queryset, table, index=None):
+        plan = self.get_plan(queryset)
+        self.assertNotIn('Seq Scan on {}'.format(table), plan)
+        if index:
+            self.assertIn(index, plan)
+
+    def test_reservation_by_code(self):
+        self.assertUsesIndex(
+            Reservation.objects.filter(code='c1234'),
+            'visits_reservation', 'visits_reservation_code_uniq')
+
+    def test_reservations_by_showing_and_email(self):
+        self.assertUsesIndex(
+            Reservation.objects.filter(showing=self.showing, email='visitor1@mail.com'),
+            'visits_reservation')
+
+    def test_reservations_modified_yesterday(self):
+        today = datetime.combine(self.now.date(), datetime.min.time())
+        self.assertUsesIndex(
+            Reservation.objects.filter(
+                last_modified__gte=today - timedelta(days=1),
+                last_modified__lt=today),
+            'visits_reservation')
+
+    def test_reservations_by_showing_start(self):
+        start = datetime.combine(self.now.date() + timedelta(days=1), datetime.min.time())
+        self.assertUsesIndex(
+            Reservation.objects.filter(
+                showing__start_time__gte=start,
+                showing__start_time__lt=start + timedelta(days=1)),
+            'visits_showing')
+
+    def test_upcoming_public_showings(self):
+        self.assertUsesIndex(
+            self.showing.activity.showings.filter(
+                private=False,
+                start_time__gt=self.now,
+            ).order_by('start_time'),
+            'visits_showing')
+
+    def test_reservation_search(self):
+        self.assertUsesIndex(
+            Reservation.objects.search('visitor1234'),
+            'visits_reservation', 'visits_reserv_email_trgm')
+
+    def test_estimated_count(self):
+        total = self.n_activities * self.showings_per_activity * self.reservations_per_showing
+        queryset = Reservation.objects.order_by('pk')
+
+        with self.settings(VISITS_ADMIN_ESTIMATED_COUNT=True, VISITS_ADMIN_ESTIMATED_COUNT_THRESHOLD=1000):
+            with CaptureQueriesContext(connection) as queries:
+                count = EstimatedCountPaginator(queryset, 100).count
+                filtered = EstimatedCountPaginator(queryset.filter(showing__private=False), 100).count
+            small = EstimatedCountPaginator(queryset.filter(code='c1234'), 100).count
+
+        self.assertFalse([q for q in queries.captured_queries if 'COUNT(' in q['sql']])
+        self.assertAlmostEqual(count, total, delta=total * 0.1)
+        self.assertAlmostEqual(filtered, total * 0.8, delta=total * 0.25)
+        # Below the threshold the exact count is used
+        self.assertEqual(small, 1)
@@ -1,10 +1,23 @@
-from djangoplicity.visits.tasks import reservation_reminder
+from djangoplicity.visits.tasks import queue_reservation_email, \
+    reservation_reminder, send_outbox
+from djangoplicity.visits.models import OutboxEmail, Reservation, \
+    ReservationReminder
+from django.db import connection, transaction
 from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth import get_user_model
 from .factories import factory_activity, factory_showing, factory_reservation
-from datetime import datetime, timedelta
+from datetime import date, datetime, time, timedelta
 from django.core import mail
+from django.core.mail import get_connection
+from django.core.mail.backends import locmem
+import smtplib
+import time as time_module
+from timeit import default_timer
 import pytz
+from mock import patch
+import os
+import unittest
 from django.utils.translation import gettext_lazy as _
 
 utc = pytz.timezone('UCT')
@@ -51,8 +64,288 @@ class TestDjangoplicityTask(TransactionTestCase):
             self.assertEqual(mail.outbox[0].subject, _('Reservation reminder'))
             self.assertEqual(mail.outbox[1].subject, _('Reservation reminder'))
 
+    def test_reservation_reminder_batches(self):
+        """Ensure the reminders are sent in batches over one connection."""
+        with self.settings(SITE_ENVIRONMENT='prod', VISITS_REMINDER_BATCH_SIZE=1):
+            with patch('djangoplicity.visits.tasks.get_connection',
+                    wraps=get_connection) as mock_get_connection:
+                reservation_reminder()
+            self.assertEqual(mock_get_connection.call_count, 1)
+            self.assertEqual(len(mail.outbox), 2)
+
+    def test_reservation_reminder_queries(self):
+        """Ensure the number of queries doesn't depend on the number of reminders."""
+        def count_queries():
+            ReservationReminder.objects.all().delete()
+            with self.settings(SITE_ENVIRONMENT='prod'):
+                with CaptureQueriesContext(connection) as queries:
+                    reservation_reminder()
+            return len(queries)
+
+        count_queries()  # Warm up the caches (templates, site)
+        n_queries = count_queries()
+        for i in range(2):
+            factory_reservation(self.showing, {'n_spaces': 1}).save()
+        self.assertEqual(count_queries(), n_queries)
+        self.assertEqual(len(mail.outbox), 8)
+
+    def test_reservation_reminder_sent_once(self):
+        """Ensure a re-run doesn't send the reminders again."""
+        with self.settings(SITE_ENVIRONMENT='prod'):
+            reservation_reminder()
+            reservation_reminder()
+            self.assertEqual(len(mail.outbox), 2)
+            self.assertEqual(ReservationReminder.objects.count(), 2)
+
+    def test_reservation_reminder_partly_sent(self):
+        """Ensure the reminders sent before an SMTP error are recorded."""
+        with self.settings(SITE_ENVIRONMENT='prod',
+                EMAIL_BACKEND='tests.test_task.FlakyEmailBackend'):
+            with self.assertRaises(smtplib.SMTPServerDisconnected):
+                reservation_reminder()
+            self.assertEqual(len(mail.outbox), 1)
+            self.assertEqual(ReservationReminder.objects.count(), 1)
+
+    def test_reservation_reminder_unexpected_error(self):
+        """Ensure the reminders sent before any other error are recorded."""
+        with self.settings(SITE_ENVIRONMENT='prod',
+                EMAIL_BACKEND='tests.test_task.BadMessageEmailBackend'):
+            with self.assertRaises(ValueError):
+                reservation_reminder()
+            self.assertEqual(len(mail.outbox), 1)
+            self.assertEqual(ReservationReminder.objects.count(), 1)
+
+    def test_reservation_reminder_deduplicated(self):
+        """Ensure a reservation upcoming and modified yesterday gets one reminder."""
+        yesterday = datetime.combine(date.today() - timedelta(days=1), time(12))
+        Reservation.objects.filter(code='abc13').update(last_modified=yesterday)
+        with self.settings(SITE_ENVIRONMENT='prod'):
+            reservation_reminder()
+            self.assertEqual(len(mail.outbox), 2)
+            self.assertEqual(
+                sorted(ReservationReminder.objects.filter(
+                    reservation__code='abc13').values_list('kind', flat=True)),
+                [ReservationReminder.MODIFIED, ReservationReminder.UPCOMING])
+
+            # Modified again after the reminder was sent
+            Reservation.objects.filter(code='abc13').update(
+                last_modified=yesterday + timedelta(minutes=1))
+            ReservationReminder.objects.update(sent=yesterday)
+            reservation_reminder()
+            self.assertEqual(len(mail.outbox), 3)
+
+    def test_reservation_reminder_showing_timezone(self):
+        """Ensure the reminders are due according to the showing timezone."""
+        for name, hours in (('Pacific/Kiritimati', 2), ('Pacific/Pago_Pago', -1)):
+            local_now = datetime.now(pytz.timezone(name)).replace(tzinfo=None)
+            showing = factory_showing(self.activity, {
+                "private": False,
+                "total_spaces": 20,
+                "timezone": name,
+                "start_time": local_now + timedelta(hours=hours),
+            })
+            showing.save()
+            factory_reservation(showing, {'code': name, 'n_spaces': 1}).save()
+
+        with self.settings(SITE_ENVIRONMENT='prod'):
+            reservation_reminder()
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertTrue(ReservationReminder.objects.filter(
+            reservation__code='Pacific/Kiritimati').exists())
+        self.assertFalse(ReservationReminder.objects.filter(
+            reservation__code='Pacific/Pago_Pago').exists())
+
+    def test_reservation_reminder_hour(self):
+        """Ensure the upcoming reminders wait for the reminder hour."""
+        with self.settings(SITE_ENVIRONMENT='prod', VISITS_REMINDER_HOUR=24):
+            reservation_reminder()
+            self.assertEqual(len(mail.outbox), 0)
+
     def test_reminder_not_run_develop(self):
         """Ensure the task not runs in develop."""
         with self.settings(SITE_ENVIRONMENT='dev'):
             reservation_reminder()
             self.assertEqual(len(mail.outbox), 0)
+
+
+class SlowEmailBackend(locmem.EmailBackend):
+    """
+    In-memory backend with a fixed latency per message, to simulate the
+    round-trips to an SMTP server
+    """
+    latency = 0.05
+
+    def send_messages(self, messages):
+        time_module.sleep(self.latency * len(messages))
+        return super(SlowEmailBackend, self).send_messages(messages)
+
+
+class FlakyEmailBackend(locmem.EmailBackend):
+    """
+    In-memory backend which loses the connection after the first message
+    """
+    error = smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+
+    def send_messages(self, messages):
+        if mail.outbox:
+            raise self.error
+        return super(FlakyEmailBackend, self).send_messages(messages)
+
+
+class BadMessageEmailBackend(FlakyEmailBackend):
+    """
+    In-memory backend which can't send the second message
+    """
+    error = ValueError('Header values can\'t contain newlines')
+
+
+@unittest.skipUnless(os.environ.get('VISITS_BENCHMARK'),
+    'set VISITS_BENCHMARK=1 to run the benchmarks')
+class TestReminderBenchmark(TransactionTestCase):
+    fixtures = ['visits']
+    n_reservations = 48
+
+    def setUp(self):
+        activity = factory_activity({})
+        showing = factory_showing(activity, {
+            "private": False,
+            "total_spaces": self.n_reservations,
+            "start_time": datetime.now(utc) + timedelta(days=1)
+        })
+        showing.save()
+        for i in range(self.n_reservations):
+            factory_reservation(showing, {'n_spaces': 1}).save()
+
+    def send_reminders(self, workers):
+        ReservationReminder.objects.all().delete()
+        mail.outbox = []
+        with self.settings(SITE_ENVIRONMENT='prod', VISITS_REMINDER_WORKERS=workers,
+                EMAIL_BACKEND='tests.test_task.SlowEmailBackend'):
+            start = default_timer()
+            reservation_reminder()
+            duration = default_timer() - start
+        self.assertEqual(len(mail.outbox), self.n_reservations)
+        return self.n_reservations / duration
+
+    def test_reminder_workers_benchmark(self):
+        """Compare the messages per second sent with 1, 4 and 16 workers."""
+        rates = {workers: self.send_reminders(workers) for workers in (1, 4, 16)}
+        summary = ', '.join(
+            '{} worker(s): {:.0f} msg/s'.format(workers, rates[workers])
+            for workers in sorted(rates))
+        self.assertGreater(rates[4], 1.5 * rates[1], summary)
+        self.assertGreater(rates[16], rates[4], summary)
+
+
+class TestReservationEmailTask(TransactionTestCase):
+    fixtures = ['visits']
+
+    def setUp(self):
+        self.activity = factory_activity({})
+        self.showing = factory_showing(self.activity, {
+            "private": False,
+            "total_spaces": 20,
+            "start_time": datetime.now(utc) + timedelta(days=1)
+        })
+        self.showing.save()
+        self.reservation = factory_reservation(self.showing, {'n_spaces': 1})
+        self.reservation.save()
+
+    def test_email_queued_after_commit(self):
+        """Ensure the outbox is only sent once the transaction commits."""
+        with patch.object(send_outbox, 'delay') as delay:
+            with transaction.atomic():
+                queue_reservation_email(self.reservation, 'confirmation')
+                self.assertEqual(OutboxEmail.objects.count(), 1)
+                delay.assert_not_called()
+            delay.assert_called_once_with()
+
+    def test_email_queued_broker_down(self):
+        """Ensure an unreachable broker doesn't fail the committed change."""
+        with patch.object(send_outbox, 'delay', side_effect=IOError('Connection refused')):
+            with transaction.atomic():
+                queue_reservation_email(self.reservation, 'updated')
+        self.assertEqual(OutboxEmail.objects.get().status, OutboxEmail.PENDING)
+
+    def test_email_not_queued_on_rollback(self):
+        with patch.object(send_outbox, 'delay') as delay:
+            try:
+                with transaction.atomic():
+                    queue_reservation_email(self.reservation, 'updated')
+                    raise ValueError
+            except ValueError:
+                pass
+            delay.assert_not_called()
+        self.assertEqual(OutboxEmail.objects.count(), 0)
+
+    def test_send_updated_email(self):
+        queue_reservation_email(self.reservation, 'updated')
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].subject, _('Reservation updated'))
+        self.assertEqual(mail.outbox[0].to, [self.reservation.email])
+        email = OutboxEmail.objects.get()
+        self.assertEqual(email.status, OutboxEmail.SENT)
+        self.assertEqual(email.attempts, 1)
+
+    def test_send_deleted_email(self):
+        """Ensure the email of a deleted reservation can still be sent."""
+        with transaction.atomic():
+            queue_reservation_email(self.reservation, 'deleted')
+            self.reservation.delete()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].subject, _('Reservation deleted'))
+        self.assertEqual(mail.outbox[0].to, [self.reservation.email])
+
+    def test_send_outbox_batches(self):
+        with patch.object(send_outbox, 'delay'):
+            for i in range(5):
+                queue_reservation_email(self.reservation, 'updated')
+        with self.settings(VISITS_OUTBOX_BATCH_SIZE=2, VISITS_OUTBOX_CONNECTIONS=2):
+            send_outbox()
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(OutboxEmail.objects.backlog()['pending'], 0)
+
+    def test_send_outbox_retry(self):
+        """Ensure failed emails are retried later and then given up."""
+        with patch.object(send_outbox, 'delay'):
+            queue_reservation_email(self.reservation, 'updated')
+
+        with patch('djangoplicity.visits.tasks.get_connection') as mock_get_connection:
+            mock_get_connection.return_value.send_messages.side_effect = \
+                smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+            send_outbox()
+
+            email = OutboxEmail.objects.get()
+            self.assertEqual(email.status, OutboxEmail.PENDING)
+            self.assertEqual(email.attempts, 1)
+            self.assertGreater(email.next_attempt, datetime.now())
+            self.assertIn('Connection unexpectedly closed', email.last_error)
+
+            # Not due yet
+            send_outbox()
+            self.assertEqual(OutboxEmail.objects.get().attempts, 1)
+
+            OutboxEmail.objects.update(next_attempt=datetime.now())
+            with self.settings(VISITS_OUTBOX_MAX_ATTEMPTS=2):
+                send_outbox()
+
+        email = OutboxEmail.objects.get()
+        self.assertEqual(email.status, OutboxEmail.FAILED)
+        self.assertEqual(OutboxEmail.objects.backlog()['failed'], 1)
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_send_outbox_unexpected_error(self):
+        """Ensure any sending error is recorded on the email instead of
+        aborting the batch."""
+        with patch.object(send_outbox, 'delay'):
+            queue_reservation_email(self.reservation, 'updated')
+
+        with patch('djangoplicity.visits.tasks.get_connection') as mock_get_connection:
+            mock_get_connection.return_value.send_messages.side_effect = \
+                ValueError('Header values can\'t contain newlines')
+            send_outbox()
+
+        email = OutboxEmail.objects.get()
+        self.assertEqual(email.status, OutboxEmail.PENDING)
+        self.assertEqual(email.attempts, 1)
+        self.assertIn('newlines', email.last_error)
@@ -1,9 +1,21 @@
-from django.test import Client
+import json
+from datetime import datetime, timedelta
+from unittest import skipUnless
+from django.db import connection
+from django.test import Client, RequestFactory
 from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth import get_user_model
 from .factories import factory_activity, factory_showing, factory_reservation, create_datetime
 from django.core import mail
+from django.core.cache import cache
 from django.forms.models import model_to_dict
+from django.utils import translation
+from django.utils.html import escape
+from mock import patch
+from djangoplicity.visits.models import Reservation, Showing
+from djangoplicity.visits.views import ReservationCreateView, ReservationUpdateView, \
+    ShowingReportListView
 
 user_client = Client()
 public_client = Client()
@@ -23,6 +35,7 @@ class TestShowingView(TransactionTestCase):
         )
         self.user_client.force_login(self.admin_user)
         self.activity = factory_activity({})
+        cache.clear()
 
     # test showing report view
     def test_showing_report_list_view(self):
@@ -32,11 +45,78 @@ class TestShowingView(TransactionTestCase):
         self.assertEquals(user_response.status_code, 200)
         self.assertEquals(public_response.status_code, 302)
 
+    def test_showing_report_list_search(self):
+        showing = factory_showing(self.activity, {
+            "private": False,
+            "total_spaces": 20,
+        })
+        showing.save()
+        other = factory_showing(factory_activity({}), {
+            "private": False,
+            "total_spaces": 20,
+        })
+        other.save()
+        factory_reservation(showing, {"email": "findme@mail.com", "n_spaces": 1}).save()
+        factory_reservation(other, {"email": "other@mail.com", "n_spaces": 1}).save()
+
+        response = self.user_client.get('/visits/reports/', {'q': 'findme'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("findme@mail.com", response.content)
+        self.assertNotIn("other@mail.com", response.content)
+        self.assertEqual(list(response.context['showing_list']), [showing])
+
+    def test_showing_report_list_occupancy(self):
+        past = factory_showing(self.activity, {
+            "private": False,
+            "total_spaces": 10,
+            "start_time": create_datetime(2021, 12, 1, 10, 0, 0, 00000)
+        })
+        past.save()
+        upcoming = factory_showing(factory_activity({}), {
+            "private": False,
+            "total_spaces": 20,
+        })
+        upcoming.save()
+        for n_spaces in (2, 3):
+            factory_reservation(past, {"n_spaces": n_spaces}).save()
+
+        response = self.user_client.get('/visits/reports/', {'when': 'past'})
+        showings = list(response.context['showing_list'])
+        self.assertEqual(showings, [past])
+        self.assertEqual(showings[0].n_reservations, 2)
+        self.assertEqual(showings[0].reserved_spaces, 5)
+        self.assertEqual(showings[0].occupancy, 50)
+        self.assertIn('50%', response.content)
+
+        response = self.user_client.get('/visits/reports/', {'when': 'upcoming'})
+        self.assertEqual(list(response.context['showing_list']), [upcoming])
+
+        response = self.user_client.get('/visits/reports/', {'activity': self.activity.pk})
+        self.assertEqual(list(response.context['showing_list']), [past])
+
+        response = self.user_client.get('/visits/reports/', {
+            'start_date': '2021-12-01', 'end_date': '2021-12-01'})
+        self.assertEqual(list(response.context['showing_list']), [past])
+
+    def test_showing_report_list_pagination(self):
+        for i in range(3):
+            factory_showing(self.activity, {"total_spaces": 10}).save()
+
+        with patch.object(ShowingReportListView, 'paginate_by', 2):
+            response = self.user_client.get('/visits/reports/', {'when': 'upcoming'})
+            self.assertEqual(len(response.context['showing_list']), 2)
+            self.assertIn('when=upcoming&amp;page=2', response.content)
+
+            response = self.user_client.get('/visits/reports/', {'when': 'upcoming', 'page': 2})
+            self.assertEqual(len(response.context['showing_list']), 1)
+
     # test showing detail view
     def test_showing_detail_view(self):
         # Create a public showing at 2021-12-01 23:59
         showing = factory_showing(self.activity, {
             "private": False,
+            "total_spaces": 20,
             "start_time": create_datetime(2021, 12, 1, 23, 59, 59, 00000)
         })
         showing.save()
@@ -56,6 +136,43 @@ class TestShowingView(TransactionTestCase):
         self.assertIn("reservation3@mail.com", response.content)
         self.assertEquals(response.status_code, 200)
 
+    def test_showing_report_manifest(self):
+        showing = factory_showing(self.activity, {
+            "private": True,
+            "total_spaces": 20,
+        })
+        showing.save()
+        for i in range(1, 4):
+            factory_reservation(showing, {
+                "email": "reservation{}@mail.com".format(i),
+                "n_spaces": 1,
+            }).save()
+        url = '/visits/reports/{}/'.format(showing.id)
+
+        response = self.user_client.get(url + 'manifest.csv')
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(lines[0].startswith('name,email,phone'))
+        self.assertEqual(len(lines), 4)
+        for i, line in enumerate(lines[1:], 1):
+            self.assertIn(',reservation{}@mail.com,'.format(i), line)
+
+        response = self.user_client.get(url + 'manifest.xlsx')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(b''.join(response.streaming_content).startswith(b'PK'))
+
+        response = self.public_client.get(url + 'manifest.csv')
+        self.assertEqual(response.status_code, 302)
+
+        # The languages are loaded along with the reservations
+        with CaptureQueriesContext(connection) as queries:
+            self.user_client.get(url)
+        n_queries = len(queries.captured_queries)
+        factory_reservation(showing, {"n_spaces": 1}).save()
+        with CaptureQueriesContext(connection) as queries:
+            self.user_client.get(url)
+        self.assertEqual(len(queries.captured_queries), n_queries)
+
     # Activity showing list
     def test_showing_list_by_activity(self):
         factory_activity({
@@ -68,6 +185,65 @@ class TestShowingView(TransactionTestCase):
         self.assertEqual(response.status_code, 200)
         self.assertIn('Test Activity Name', response.content)
 
+    # Showing list is served from the cache until availability changes
+    def test_showing_list_cache(self):
+        showing = factory_showing(self.activity, {
+            "private": False,
+            "total_spaces": 20,
+            "free_spaces": None,
+        })
+        showing.save()
+        url = '/visits/{}/'.format(self.activity.pk)
+
+        response = self.public_client.get(url)
+        self.assertIn('Available places: 20', response.content)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.public_client.get(url)
+        self.assertIn('Available places: 20', response.content)
+        self.assertFalse([q for q in queries.captured_queries if 'visits_' in q['sql']])
+
+        factory_reservation(showing, {
+            "n_spaces": 3
+        }).save()
+        response = self.public_client.get(url)
+        self.assertIn('Available places: 17', response.content)
+
+    # JSON availability with ETag
+    def test_showing_availability(self):
+        showing = factory_showing(self.activity, {
+            "private": False,
+            "total_spaces": 4,
+            "free_spaces": None,
+        })
+        showing.save()
+        url = '/visits/{}/availability/'.format(self.activity.pk)
+
+        response = self.public_client.get(url)
+        etag = response['ETag']
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode('utf-8')), [{
+            'id': showing.pk,
+            'start': Showing.objects.get(pk=showing.pk).start_time.isoformat(),
+            'free_spaces': 4,
+            'fully_booked': False,
+        }])
+
+        response = self.public_client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        factory_reservation(showing, {
+            "n_spaces": 4
+        }).save()
+        response = self.public_client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertTrue(json.loads(response.content.decode('utf-8'))[0]['fully_booked'])
+
+    def test_showing_availability_not_found(self):
+        response = self.public_client.get('/visits/does-not-exist/availability/')
+        self.assertEqual(response.status_code, 404)
+
     # Activity not exist
     def test_activity_not_found(self):
         response = self.user_client.get('/visits/does-not-exist/')
@@ -127,6 +303,62 @@ class TestReservationView(TransactionTestCase):
         self.assertEqual(len(mail.outbox), 1)
         self.assertEqual(response.status_code, 200)
 
+    def test_create_reservation_page_queries(self):
+        other = factory_showing(self.activity, {
+            "private": False,
+            "total_spaces": 20
+        })
+        other.save()
+
+        view = ReservationCreateView()
+        view.request = RequestFactory().get(self.create_url)
+        view.args = ()
+        view.kwargs = {'showingpk': self.showing.pk}
+        view.object = None
+
+        # The showing and its activity, the offered languages and the other
+        # showings of the activity
+        with translation.override(self.activity.lang):
+            with self.assertNumQueries(3):
+                context = view.get_context_data()
+                context['form'].as_p()
+                other_showings = list(context['other_showings'])
+
+        self.assertEqual(context['activity'], self.activity)
+        self.assertEqual(set(other_showings), {self.showing, other})
+
+    @skipUnless(connection.vendor == 'postgresql', 'Codes are only generated before the INSERT on PostgreSQL')
+    def test_create_reservation_single_write(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.create_url, data=self.data)
+
+        writes = [
+            q['sql'] for q in queries.captured_queries
+            if q['sql'].startswith(('INSERT', 'UPDATE')) and '"visits_reservation"' in q['sql']
+        ]
+        reservation = Reservation.objects.get(showing=self.showing)
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(len(writes), 1)
+        self.assertTrue(writes[0].startswith('INSERT'))
+        self.assertNotEqual(reservation.code, '')
+
+    def test_create_reservation_booking_closed(self):
+        self.showing.start_time = datetime.now() + timedelta(hours=2)
+        self.showing.save()
+
+        response = self.client.get(self.create_url)
+        self.assertTrue(response.context['too_late'])
+
+        response = self.client.post(self.create_url, data=self.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(self.showing.reservation_set.exists())
+        self.assertEqual(len(mail.outbox), 0)
+
+        # Nor listed anymore
+        response = self.client.get('/visits/{}/'.format(self.activity.pk))
+        self.assertNotIn(self.showing, response.context['showing_list'])
+
     def test_bad_email_confirmation_to_create_reservation(self):
         data = self.data.copy()
         data.update({
@@ -182,6 +414,48 @@ class TestReservationView(TransactionTestCase):
         self.assertEqual('/visits/confirmed/abc12/', response.url)
         self.assertEqual(response.status_code, 302)
 
+    def test_update_reservation_invalid_context(self):
+        """Ensure the page of a rejected change is about the stored reservation."""
+        reservation = factory_reservation(self.showing, {"code": "abc12", 'n_spaces': 1})
+        reservation.save()
+        other = factory_reservation(self.showing, {"code": "abc13", 'n_spaces': 1})
+        other.email = reservation.email
+        other.save()
+
+        data = model_to_dict(reservation)
+        data.update({
+            "email": "changed@mail.com",
+            "email_confirm": "other@mail.com",
+        })
+        data.pop('created')
+        data.pop('last_modified')
+        response = self.client.post("/visits/update/abc12/", data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context['other_reservations']), [other])
+
+    def test_update_reservation_page_queries(self):
+        factory_reservation(self.showing, {
+            "code": "abc12",
+            'n_spaces': 1,
+        }).save()
+
+        view = ReservationUpdateView()
+        view.request = RequestFactory().get("/visits/update/abc12/")
+        view.args = ()
+        view.kwargs = {'code': 'abc12'}
+
+        # The reservation with its showing, activity and language, then the
+        # languages offered by the showing
+        with translation.override(self.activity.lang):
+            with self.assertNumQueries(2):
+                view.object = view.get_object()
+                context = view.get_context_data()
+                context['form'].as_p()
+                view.get_object()
+
+        self.assertEqual(context['activity'], self.activity)
+
     # Not update reservation by email confirmation
     def test_not_allow_changes_in_reservation_lack_email_confirmation(self):
         reservation = factory_reservation(self.showing, {
@@ -239,3 +513,146 @@ class TestReservationView(TransactionTestCase):
         self.assertEqual(len(mail.outbox), 1)
         self.assertEqual("/visits/reservation-cancelled/", response.url)
         self.assertEqual(response.status_code, 302)
+
+
+class TestReservationExportView(TransactionTestCase):
+    fixtures = ['visits']
+
+    def setUp(self):
+        self.user_client = user_client
+        self.admin_user = get_user_model().objects.create_superuser(
+            username='admin1',
+            email='admin1@newsletters.org',
+            password='password123'
+        )
+        self.user_client.force_login(self.admin_user)
+        self.showing = factory_showing(factory_activity({}), {
+            "private": False,
+            "total_spaces": 20,
+            "start_time": create_datetime(2021, 12, 1, 10, 30, 0, 00000)
+        })
+        self.showing.save()
+        for i in range(1, 4):
+            factory_reservation(self.showing, {
+                "email": "reservation{}@mail.com".format(i)
+            }).save()
+
+    def test_stream_csv(self):
+        response = self.user_client.get('/admin/visits/reservation/export/stream/csv/')
+        content = b''.join(response.streaming_content).decode('utf-8')
+        lines = content.splitlines()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertTrue(lines[0].startswith('id,showing,date,time,name'))
+        self.assertEqual(len(lines), 4)
+        self.assertIn('reservation1@mail.com', content)
+        self.assertIn(',2021-12-01,10:30 AM ', content)
+
+    def test_stream_csv_formula(self):
+        """Ensure the fields entered by visitors can't be run as formulas."""
+        Reservation.objects.filter(email='reservation1@mail.com').update(
+            name='=HYPERLINK("http://example.com")')
+        response = self.user_client.get('/admin/visits/reservation/export/stream/csv/')
+        content = b''.join(response.streaming_content).decode('utf-8')
+
+        self.assertIn(',"\'=HYPERLINK(""http://example.com"")",', content)
+
+    def test_stream_xlsx(self):
+        response = self.user_client.get('/admin/visits/reservation/export/stream/xlsx/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(b''.join(response.streaming_content).startswith(b'PK'))
+
+    def test_changelist_export_links(self):
+        response = self.user_client.get('/admin/visits/reservation/?showing_date=upcoming')
+        self.assertIn('/admin/visits/reservation/export/stream/csv/?showing_date=upcoming',
+                      response.content.decode('utf-8'))
+
+    def test_stream_requires_staff(self):
+        response = public_client.get('/admin/visits/reservation/export/stream/csv/')
+        self.assertEqual(response.status_code, 302)
+
+
+class TestAdminChangelists(TransactionTestCase):
+    fixtures = ['visits']
+
+    def setUp(self):
+        self.user_client = user_client
+        self.admin_user = get_user_model().objects.create_superuser(
+            username='admin1',
+            email='admin1@newsletters.org',
+            password='password123'
+        )
+        self.user_client.force_login(self.admin_user)
+
+    def add_showings(self, n):
+        for i in range(n):
+            showing = factory_showing(factory_activity({}), {
+                "private": False,
+                "total_spaces": 20,
+                "timezone": "America/Santiago",
+            })
+            showing.save()
+            factory_reservation(showing, {"n_spaces": 1}).save()
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.user_client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries.captured_queries)
+
+    def assertConstantQueries(self, url):
+        self.add_showings(2)
+        n_queries = self.count_queries(url)
+        self.add_showings(5)
+        self.assertEqual(self.count_queries(url), n_queries)
+
+    def test_showing_changelist_queries(self):
+        self.assertConstantQueries('/admin/visits/showing/')
+
+    def test_reservation_changelist_queries(self):
+        self.assertConstantQueries('/admin/visits/reservation/')
+
+    def test_reservation_changelist_columns(self):
+        self.add_showings(1)
+        reservation = Reservation.objects.select_related('showing__activity').get()
+        response = self.user_client.get('/admin/visits/reservation/')
+
+        self.assertIn(escape(reservation.showing.activity.name), response.content.decode('utf-8'))
+        self.assertIn(reservation.showing.start_time.strftime('%Y-%m-%d'), response.content.decode('utf-8'))
+        self.assertNotIn("(u'", response.content.decode('utf-8'))
+        self.assertIn(' CLT', response.content.decode('utf-8'))
+
+    def test_reservation_changelist_showing_date_filter(self):
+        self.add_showings(1)
+        past = factory_showing(factory_activity({}), {
+            "start_time": create_datetime(2020, 1, 1, 10, 0, 0, 00000)
+        })
+        past.save()
+        past_reservation = factory_reservation(past, {"email": "past@mail.com"})
+        past_reservation.save()
+
+        response = self.user_client.get('/admin/visits/reservation/?showing_date=upcoming')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('past@mail.com', response.content.decode('utf-8'))
+
+        response = self.user_client.get('/admin/visits/reservation/?showing_date=past')
+        self.assertIn('past@mail.com', response.content.decode('utf-8'))
+
+    def test_reservation_changelist_date_hierarchy(self):
+        past = factory_showing(factory_activity({}), {
+            "start_time": create_datetime(2020, 1, 1, 10, 0, 0, 00000)
+        })
+        past.save()
+        factory_reservation(past, {"email": "past@mail.com"}).save()
+        self.add_showings(1)
+
+        response = self.user_client.get('/admin/visits/reservation/')
+        self.assertIn('?showing__start_time__year=2020', response.content.decode('utf-8'))
+
+        response = self.user_client.get(
+            '/admin/visits/reservation/?showing__start_time__year=2020&showing__start_time__month=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('past@mail.com', response.content.decode('utf-8'))
+        self.assertIn('showing__start_time__day=31', response.content.decode('utf-8'))